@@ -2,8 +2,9 @@
 from .workerpool import RVWorkerPool
 from .config import RVConfig
 from .ik import RVIK, RVSolver
+from .sweep import RVSweep
 from .uiext import *
-from .outline import RVOutline
+from .outline import RVOutline, RVRasterOutline, RVOutlineLayer
 from .heatmap import RVHeatmap
 from .load_histogram import RVLoadHistogram
 from .view import RVView
@@ -4,7 +4,7 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
-from robovis import RVIK
+from robovis.ik import solvePoint
 
 class RVArmVis(object):
     '''Solves IK for and visualizes a configuration of the robot arm'''
@@ -13,7 +13,6 @@ class RVArmVis(object):
         self.goal = np.array([0,0])
         self.res = None
         self.config = config
-        self.ik = RVIK(config, point=self.goal)
         self.view = view
         # Options
         self.color = kwargs.pop('color', QColor(100, 100, 100))
@@ -26,29 +25,51 @@ class RVArmVis(object):
         }
 
         self.scene = view.scene
-        self.graphics = []
+        self.createGraphics()
         self.update()
 
+    def createGraphics(self):
+        '''Creates the (hidden) scene items, which are reused by every update'''
+        pen = QPen(self.color, self.thickness)
+        self.elbow_line = self.scene.addLine(QLineF(), pen)
+        self.forearm_line = self.scene.addLine(QLineF(), pen)
+        self.lower_line = self.scene.addLine(QLineF(), pen)
+        self.linkage_line = self.scene.addLine(QLineF(), pen)
+        self.arm_graphics = [self.elbow_line, self.forearm_line,
+                             self.lower_line, self.linkage_line]
+
+        self.force_P_line = self.scene.addLine(QLineF(), QPen(QBrush(Qt.blue), 2))
+        self.force_F_line = self.scene.addLine(QLineF(), QPen(QBrush(Qt.blue), 2))
+        self.force_L_line = self.scene.addLine(QLineF(), QPen(QBrush(Qt.yellow), 2))
+        self.force_graphics = [self.force_P_line, self.force_F_line, self.force_L_line]
+
+        self.coords_box = self.scene.addRect(QRectF(), brush=QBrush(Qt.black))
+        self.coords_box.setOpacity(0.5)
+        self.coords_text = self.scene.addText('')
+        self.load_text = self.scene.addText('')
+        for text in (self.coords_text, self.load_text):
+            text.setTransform(QTransform.fromScale(1,-1))
+            text.setDefaultTextColor(Qt.white)
+        self.coords_graphics = [self.coords_box, self.coords_text, self.load_text]
+
+        self.graphics = self.arm_graphics + self.force_graphics + self.coords_graphics
+        self.clearGraphics()
+
     def changeConfig(self, config):
         self.config = config
-        self.ik.setConfig(config)
         self.update()
 
     def changeGoal(self, goal):
         self.goal = goal
-        self.ik.setPoint(goal)
         self.update()
 
     def clearGraphics(self):
         for item in self.graphics:
-            self.scene.removeItem(item)
-        self.graphics = []
+            item.hide()
 
     def update(self):
-        self.clearGraphics()
-        self.ik.calculate()
-        res = self.ik.point_results
-        if res is not None and res['ok']:
+        res = solvePoint(self.config, self.goal)
+        if res['ok']:
             self.res = res
             self.displayed = True
             origin = QPointF(0,0)
@@ -57,55 +78,33 @@ class RVArmVis(object):
             end = QPointF(res['goal_pos'][0], res['goal_pos'][1])
             lower_actuator = QPointF(res['lower_actuator'][0], res['lower_actuator'][1])
 
-            pen = QPen(self.color, self.thickness)
-
-            lineDef = QLineF(origin, elbow)
-            elbow_line = self.scene.addLine(lineDef, pen)
-
-            lineDef = QLineF(upper_actuator, end)
-            forearm_line = self.scene.addLine(lineDef, pen)
-
-            lineDef = QLineF(origin, lower_actuator)
-            lower_line = self.scene.addLine(lineDef, pen)
-
-            lineDef = QLineF(upper_actuator, lower_actuator)
-            linkage_line = self.scene.addLine(lineDef, pen)
-
-            self.graphics.append(elbow_line)
-            self.graphics.append(forearm_line)
-            self.graphics.append(lower_line)
-            self.graphics.append(linkage_line)
+            self.elbow_line.setLine(QLineF(origin, elbow))
+            self.forearm_line.setLine(QLineF(upper_actuator, end))
+            self.lower_line.setLine(QLineF(origin, lower_actuator))
+            self.linkage_line.setLine(QLineF(upper_actuator, lower_actuator))
+            for item in self.arm_graphics:
+                item.show()
 
             if self.show_forces:
                 P = QPointF(res['P'][0], res['P'][1])
-                lineDef = QLineF(upper_actuator, upper_actuator + P)
-                force_P_line = self.scene.addLine(lineDef, QPen(QBrush(Qt.blue), 2))
-                self.graphics.append(force_P_line)
+                self.force_P_line.setLine(QLineF(upper_actuator, upper_actuator + P))
                 F = QPointF(res['F'][0], res['F'][1])
-                lineDef = QLineF(elbow, elbow + F)
-                force_F_line = self.scene.addLine(lineDef, QPen(QBrush(Qt.blue), 2))
-                self.graphics.append(force_F_line)
+                self.force_F_line.setLine(QLineF(elbow, elbow + F))
                 L = QPointF(res['L'][0], res['L'][1])
-                lineDef = QLineF(end, end + L)
-                force_L_line = self.scene.addLine(lineDef, QPen(QBrush(Qt.yellow), 2))
-                self.graphics.append(force_L_line)
+                self.force_L_line.setLine(QLineF(end, end + L))
+            for item in self.force_graphics:
+                item.setVisible(self.show_forces)
 
             if self.show_coords:
-                rect = QRectF(end + QPointF(10, -5), end + QPointF(120, -40))
-                box = self.scene.addRect(rect, brush=QBrush(Qt.black))
-                box.setOpacity(0.5)
-                self.graphics.append(box)
-                text = self.scene.addText('{0:.2f}, {1:.2f} mm'.format(end.x(), end.y()))
-                text.setTransform(QTransform.fromScale(1,-1))
-                text.setPos(end + QPoint(10, -5))
-                text.setDefaultTextColor(Qt.white)
-                self.graphics.append(text)
-                text = self.scene.addText('{0:.2f} N'.format(res['load']))
-                text.setTransform(QTransform.fromScale(1,-1))
-                text.setPos(end + QPoint(10, -20))
-                text.setDefaultTextColor(Qt.white)
-                self.graphics.append(text)
+                self.coords_box.setRect(QRectF(end + QPointF(10, -5), end + QPointF(120, -40)))
+                self.coords_text.setPlainText('{0:.2f}, {1:.2f} mm'.format(end.x(), end.y()))
+                self.coords_text.setPos(end + QPoint(10, -5))
+                self.load_text.setPlainText('{0:.2f} N'.format(res['load']))
+                self.load_text.setPos(end + QPoint(10, -20))
+            for item in self.coords_graphics:
+                item.setVisible(self.show_coords)
         else:
+            self.clearGraphics()
             self.displayed = False
             self.res = None
         self.onChanged()
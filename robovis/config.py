@@ -1,5 +1,7 @@
 import copy
 
+# Decimal places of parameter values which count towards a config's key
+key_digits = 9
 
 class RVParameter(object):
     def __init__(self, config, key, value, label='Unlabelled', min=0, max=300, divisor=10):
@@ -105,6 +107,29 @@ class RVConfig(object):
         for key, param in self.values.items():
             param.config = self
 
+    def key(self):
+        '''Canonical, hashable form of the configuration's values
+
+        Configurations with the same key produce the same solutions. Values
+        are rounded (see key_digits), so float noise doesn't matter.'''
+        return tuple(sorted((key, round(float(param.value), key_digits))
+                            for key, param in self.values.items()))
+
+    def __eq__(self, other):
+        if not isinstance(other, RVConfig):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        # Configs are mutable; don't modify one while it's in a set or dict
+        return hash(self.key())
+
     def __getitem__(self, key):
         return self.values[key]
 
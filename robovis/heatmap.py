@@ -7,31 +7,77 @@ from PyQt5.QtGui import *
 
 from robovis import RVIK
 
+# Load (in N) multiplier taking loads to colormap indices; loads beyond
+# 255/scale saturate
+default_scale = 4
+
+def colormapLUT(colormap):
+    '''ARGB32 lookup table for a cv2 colormap, indexed by uint8 level
+
+    An extra 257th entry is left fully transparent, for unreachable cells.'''
+    levels = np.arange(256, dtype=np.uint8).reshape(-1, 1)
+    bgr = cv2.applyColorMap(levels, colormap).reshape(-1, 3).astype(np.uint32)
+    lut = np.zeros(257, dtype=np.uint32)
+    lut[:256] = 0xff000000 | (bgr[:, 2] << 16) | (bgr[:, 1] << 8) | bgr[:, 0]
+    return lut
+
 class RVHeatmap(object):
-    '''Heatmap for a load distribution'''
-    def __init__(self, scene, ik):
+    '''Heatmap for a load distribution
+
+    Loads are colorized in one lookup pass, straight into a persistent ARGB32
+    pixel buffer which the heatmap's QImage wraps.'''
+    def __init__(self, scene, ik, colormap=cv2.COLORMAP_HOT, scale=default_scale):
         self.graphicsItem = scene.addPixmap(QPixmap())
+        self.ik = None
+        self.scale = scale
+        self.colormap = colormap
+        self.lut = colormapLUT(colormap)
+        # Per-cell scratch buffers and the pixel buffer, reused while the
+        # grid shape stays the same
+        self.levels = None
+        self.indices = None
+        self.unreachable = None
+        self.pixels = None
+        self.image = None
         self.update(ik)
 
+    def setColormap(self, colormap):
+        '''Switches to another cv2 colormap (e.g. cv2.COLORMAP_JET)'''
+        self.colormap = colormap
+        self.lut = colormapLUT(colormap)
+        self.update(self.ik)
+
+    def setScale(self, scale):
+        '''Sets the load multiplier; loads of 255/scale and up saturate'''
+        self.scale = scale
+        self.update(self.ik)
+
+    def allocate(self, shape):
+        self.levels = np.empty(shape, dtype=np.float64)
+        self.indices = np.empty(shape, dtype=np.uint16)
+        self.unreachable = np.empty(shape, dtype=bool)
+        self.pixels = np.empty(shape, dtype=np.uint32)
+        # Rows of the image are the grid's columns; rotated back in update
+        self.image = QImage(self.pixels.data, shape[1], shape[0], shape[1]*4, QImage.Format_ARGB32)
+
     def update(self, ik):
-        loads = np.array(ik.loads)
-        loads *= 4
-        above_255 = loads >= 255
-        loads = loads*(~above_255) + 255*np.ones(loads.shape)*above_255
-        loads = loads.astype(np.uint8)
-        alpha = ik.reachable * 255
-        alpha = alpha.astype(np.uint8)
-        loads_rgb = np.dstack([loads, loads, loads])
-        loads_rgb = cv2.applyColorMap(loads_rgb, cv2.COLORMAP_HOT)
-        loads = np.dstack([loads_rgb, alpha])
-        # cv2.imshow('colormap', loads)
-        image = QImage(loads.data, loads.shape[1], loads.shape[0], loads.shape[1]*4, QImage.Format_ARGB32)
-        pixmap = QPixmap(image)
-        self.graphicsItem.setPixmap(pixmap)
+        self.ik = ik
+        loads = ik.loads
+        if self.pixels is None or self.pixels.shape != loads.shape:
+            self.allocate(loads.shape)
+        np.multiply(loads, self.scale, out=self.levels, casting='unsafe')
+        np.clip(self.levels, 0, 255, out=self.levels)
+        # Unreachable cells may be NaN; they're masked out below
+        with np.errstate(invalid='ignore'):
+            np.copyto(self.indices, self.levels, casting='unsafe')
+        np.logical_not(ik.reachable, out=self.unreachable)
+        np.copyto(self.indices, 256, where=self.unreachable)
+        np.take(self.lut, self.indices, out=self.pixels)
+        self.graphicsItem.setPixmap(QPixmap.fromImage(self.image))
         self.graphicsItem.resetTransform()
         self.graphicsItem.setRotation(-90)
         self.graphicsItem.setTransform(QTransform.fromScale(ik.scaling_factor, ik.scaling_factor), True)
-        self.graphicsItem.setPos(0, ik.scaling_factor * ik.height/2)
+        self.graphicsItem.setPos(ik.scaling_factor * ik.origin[0], ik.scaling_factor * ik.origin[1])
 
     def show(self):
         self.graphicsItem.show()
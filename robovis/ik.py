@@ -1,14 +1,128 @@
+from collections import OrderedDict
+import math
+import weakref
+
 import numpy as np
 import cv2
 # from matplotlib import pyplot as plt
 
 from robovis import RVConfig
+from robovis.workerpool import RVJobCancelled, jobCancelled, jobBuffer, priority_main, priority_ghost
+
+def runIK(config, resolution=100, region=None, profile='full'):
+    if region is not None:
+        # Regions are cached tile by tile
+        ik = RVIK(config, region=region, cache=tile_cache, cancel=jobCancelled)
+    else:
+        ik = RVIK(config, resolution=resolution, cache=geometry_cache, cancel=jobCancelled)
+    ik.strip(profile)
+    # Hand the fields back through shared memory where possible
+    buffer = jobBuffer()
+    if buffer is not None:
+        state = packIK(ik, *buffer)
+        if state is not None:
+            return state
+    return ik
+
+# What a solution keeps hold of (see RVIK.strip): just the contours, the
+# contours and a load field to sample, or everything
+result_profiles = ('outline', 'loads', 'full')
+
+# Full-grid fields of an RVIK which are passed back through shared buffers;
+# geometry fields are prefixed with 'geometry.'
+shared_fields = (
+    'sample_field',
+    'geometry.actuator_den',
+    'geometry.elevator_den',
+    'geometry.partial_ok',
+    'actuator_loads',
+    'elevator_loads',
+    'loads',
+    'reachable',
+    'valid_indices',
+)
+
+def ikBufferSize(resolution, dtype=np.float64):
+    '''Shared buffer size, in bytes, which fits a full-range solve's fields'''
+    cells = 2*resolution**2
+    float_size = np.dtype(dtype).itemsize
+    index_size = np.dtype(np.intp).itemsize
+    # Five float fields, two masks, and up to two indices per cell
+    return cells*(5*float_size + 2 + 2*index_size) + 16*len(shared_fields)
+
+def packIK(ik, index, buffer):
+    '''Copies an RVIK's fields into a shared buffer (worker side)
+
+    Returns the rest of the RVIK's state, along with where to find each of
+    the fields in the buffer, to be passed back in place of the RVIK; see
+    unpackIK. Returns None if the fields don't fit.'''
+    base = np.frombuffer(buffer, dtype=np.uint8)
+    state = dict(ik.__dict__)
+    if ik.geometry is not None:
+        state['geometry'] = {'key': ik.geometry['key']}
+    # Just a view of the geometry's mask
+    state.pop('partial_ok', None)
+    layout = {}
+    offset = 0
+    for name in shared_fields:
+        if name.startswith('geometry.'):
+            if ik.geometry is None:
+                continue
+            field = ik.geometry[name[len('geometry.'):]]
+        else:
+            # Fields which were never evaluated, or were dropped by the
+            # result profile, are left out
+            field = state.pop(name, None)
+            if field is None:
+                continue
+        field = np.ascontiguousarray(field)
+        # Keep every field aligned
+        offset = -(-offset // 16) * 16
+        if offset + field.nbytes > base.size:
+            return None
+        view = base[offset:offset + field.nbytes].view(field.dtype).reshape(field.shape)
+        view[...] = field
+        layout[name] = (offset, field.dtype.str, field.shape)
+        offset += field.nbytes
+    state['shared'] = (index, layout)
+    return state
+
+def unpackIK(state, pool):
+    '''Rebuilds an RVIK from a packIK state, as views of the shared buffer
+
+    Nothing is copied. The buffer goes back to the pool once the RVIK and
+    every view of its fields are gone, so it can be held onto for as long
+    as it's needed. The state itself is left alone, as the pool may hand
+    the same one to several solvers.'''
+    state = dict(state)
+    index, layout = state.pop('shared')
+    for name in ('geometry', 'params', 'field_order'):
+        if state.get(name) is not None:
+            state[name] = state[name].copy()
+    base = np.frombuffer(pool.bufferArray(index), dtype=np.uint8)
+    weakref.finalize(base, pool.releaseBuffer, index)
+    ik = RVIK.__new__(RVIK)
+    ik.__dict__.update(state)
+    for name, (offset, dtype, shape) in layout.items():
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        field = base[offset:offset + size].view(dtype).reshape(shape)
+        if name.startswith('geometry.'):
+            ik.geometry[name[len('geometry.'):]] = field
+        else:
+            setattr(ik, name, field)
+    return ik
 
-def runIK(config, stamp):
-    return (RVIK(config), stamp)
+def setGeometryCacheSize(size):
+    '''Resizes this process's geometry cache (e.g. as a pool initializer)'''
+    geometry_cache.resize(size)
+
+def geometryCacheStats():
+    '''Hit/miss counters for this process's geometry cache'''
+    return geometry_cache.stats()
 
 class RVSolver(object):
-    def __init__(self, pool, config=None):
+    def __init__(self, pool, config=None, resolution=100, profile='full'):
         self.subscribers = {
             'ready': []
         }
@@ -17,27 +131,120 @@ class RVSolver(object):
         self.latest_stamp = 0
         self.ready = False
         self.res = None
+        self.ik = None
+        # Identifies the latest async solve (see RVWorkerPool.registerJob)
+        self.key = None
+        # The configuration of the latest async solve
+        self.pending_config = None
         self.pool = pool
+        self.resolution = resolution
+        # Viewport region to solve, rather than the full range (see RVIK)
+        self.region = None
+        # What the solutions are stripped down to (see RVIK.strip)
+        self.profile = profile
         self.data = {}
         if config:
             self.solveAsync(config)
 
-    def solveAsync(self, config, priority=1):
+    def solveAsync(self, config, priority=priority_ghost):
+        '''Solves in the pool, superseding any outstanding solve
+
+        Identical solves (of any solver) share a single job in the pool,
+        and recent results are reused outright.'''
+        if self.hasSolution(config):
+            return
         self.ready = False
-        copyConfig = RVConfig(config)
+        self.key = self.solveKey(config)
+        copyConfig = self.pending_config = RVConfig(config)
         self.start_stamp += 1
         self.res = self.pool.registerJob(runIK,
-                                         [copyConfig, self.start_stamp],
-                                         self, priority)
+                                         [copyConfig, self.resolution,
+                                          self.region, self.profile],
+                                         self, priority,
+                                         callback=lambda ik, stamp=self.start_stamp: self.receive(ik, stamp),
+                                         shared=True,
+                                         key=self.key)
+
+    def solveKey(self, config):
+        '''Identifies the pool job which solves config for this solver'''
+        return ('runIK', config.key(), self.resolution, self.region, self.profile)
+
+    def hasSolution(self, config):
+        '''Whether the current solution is solveAsync's for config
 
-    def solveLocal(self, config):
-        self.ik = RVIK(config)
+        solveAsync returns straight away in that case, without a callback.'''
+        return self.ready and self.key == self.solveKey(config)
+
+    def solvingGeometryFor(self, config):
+        '''Whether an outstanding async solve will have config's geometry
+
+        i.e. once it arrives, hasGeometryFor(config) will hold'''
+        if self.ready or self.key is None or self.pending_config is None:
+            return False
+        return all(self.pending_config[p].value == config[p].value for p in length_params)
+
+    def solveLocal(self, config, geometry=None, resolution=None):
+        '''Solves synchronously, superseding any outstanding async solve
+
+        If no geometry is given, the previous solution's geometry is reused
+        when possible (i.e. only load parameters have changed). The solver's
+        own resolution (and region) is used unless another resolution is
+        given, in which case the full range is solved at that resolution.'''
+        if geometry is None and self.ik is not None:
+            geometry = self.ik.geometry
+        region = self.region
+        if resolution is not None:
+            region = None
+        else:
+            resolution = self.resolution
+        ik = RVIK(config, resolution=resolution, geometry=geometry, region=region)
+        self.useSolution(ik.strip(self.profile))
+
+    def useSolution(self, ik):
+        '''Takes on an existing solution, superseding any outstanding solve'''
+        self.pool.cancel(self)
+        self.key = None
+        self.start_stamp += 1
+        self.latest_stamp = self.start_stamp
+        self.ik = ik
+        self.ready = True
         # Notify anyone that cares
         if self.outline:
             self.outline.update(self.ik)
         for func in self.subscribers['ready']:
             func(self.ik)
 
+    def solveProgressive(self, config, preview_resolution, priority=priority_main):
+        '''Solves a quick low resolution preview, then the full resolution
+
+        The preview is solved synchronously and delivered straight away, and
+        the full resolution solve goes to the pool to replace it. Either is
+        superseded by any later solve. If only the load parameters differ
+        from the current full resolution solution, it's just rescaled.'''
+        if self.hasGeometryFor(config):
+            self.solveLocal(config)
+        else:
+            self.solveLocal(config, resolution=preview_resolution)
+            self.solveAsync(config, priority)
+
+    def hasGeometryFor(self, config):
+        '''Whether the current solution's geometry can be reused for config
+
+        i.e. it's a full resolution solution (or one of the solver's region)
+        with the same lengths'''
+        ik = self.ik
+        if ik is None or ik.geometry is None or ik.point_mode or ik.adaptive:
+            return False
+        if ik.region != self.region:
+            return False
+        if self.region is None and ik.resolution != self.resolution:
+            return False
+        return ik.geometry['key'] == geometryKey(ikParams(config), ik.domain)
+
+    def setPriority(self, priority):
+        '''Re-prioritizes this solver's outstanding async solve'''
+        self.pool.setPriority(self, priority)
+
     def subscribe(self, event, func):
         self.subscribers[event].append(func)
 
@@ -55,36 +262,988 @@ class RVSolver(object):
             self.outline.solver = None
         self.outline = None
 
-    def poll(self):
-        if self.res == None:
+    def receive(self, ik, exec_stamp):
+        '''Takes delivery of an async solve, unless it has been superseded'''
+        if exec_stamp <= self.latest_stamp:
+            if isinstance(ik, dict):
+                # Superseded; the shared buffer can go straight back
+                self.pool.releaseBuffer(ik['shared'][0])
             return
-        if self.res.ready():
-            ik, exec_stamp = self.res.get()
-            if exec_stamp > self.latest_stamp:
-                self.ik = ik
-                self.latest_stamp = exec_stamp
-                # Notify anyone that cares
-                if self.outline:
-                    self.outline.update(self.ik)
-                for func in self.subscribers['ready']:
-                    func(self.ik)
-                self.ready = True
+        if isinstance(ik, dict):
+            ik = unpackIK(ik, self.pool)
+        self.ik = ik
+        self.latest_stamp = exec_stamp
+        # Ready before anyone is notified, as they may start another solve
+        self.ready = True
+        # Notify anyone that cares
+        if self.outline:
+            self.outline.update(self.ik)
+        for func in self.subscribers['ready']:
+            func(self.ik)
+
+
+# Parameters which the geometry stage of the solver depends on
+length_params = (
+    'elevator_length',
+    'forearm_length',
+    'linkage_length',
+    'lower_actuator_length',
+    'upper_actuator_length',
+)
+# Parameters which only affect the load stage
+load_params = ('actuator_torque', 'elevator_torque', 'min_load')
+# Geometry fields retained by full-range solves (point solves keep them all)
+geometry_fields = ('actuator_den', 'elevator_den', 'partial_ok')
+# Grid rows solved between cancellation checks in cancellable solves
+cancel_rows = 16
+# Cells along each side of a viewport tile (see RVIK's region mode)
+tile_cells = 64
+# Largest viewport region solved, in cells; coarser steps are used beyond it
+max_region_cells = 4000000
+# Scratch memory used by a banded solve, per cell, in array elements (this
+# covers the goals, solveGeometry's buffers and the compacted cells)
+band_cell_fields = 26
+# Default scratch memory budget of solveTiled, in bytes
+default_memory_budget = 256*1024*1024
+# Relative slack on the bounds of the reachable annulus, which is well clear
+# of rounding error at either precision
+annulus_margin = 1e-4
+
+# RVIK's result fields, and what each is evaluated from. Fields are computed
+# on first access and memoized (see RVIK.__getattr__); a dependency is either
+# another field, the geometry, or a load parameter
+field_dependencies = OrderedDict([
+    ('partial_ok', ('geometry',)),
+    ('actuator_loads', ('geometry', 'actuator_torque')),
+    ('elevator_loads', ('geometry', 'elevator_torque')),
+    ('loads', ('actuator_loads', 'elevator_loads')),
+    ('reachable', ('loads', 'partial_ok', 'min_load')),
+    ('sample_field', ('loads', 'reachable')),
+    ('contours', ('reachable',)),
+    ('valid_points', ('reachable',)),
+    ('valid_indices', ('reachable',)),
+])
+# Memoized fields which are dropped, oldest first, once they take up more
+# than field_memory_budget bytes; they're recomputed if needed again
+droppable_fields = ('actuator_loads', 'elevator_loads', 'loads', 'reachable',
+                    'sample_field', 'valid_indices')
+field_memory_budget = 64*1024*1024
+
+def ikParams(config):
+    '''Extracts the parameters used by the solver from a configuration'''
+    return {
+        'elevator_length': config['elevator_length'].value,
+        'forearm_length': config['forearm_length'].value,
+        'linkage_length': config['linkage_length'].value,
+        'lower_actuator_length': config['lower_actuator_length'].value,
+        'upper_actuator_length': config['upper_actuator_length'].value,
+        'actuator_torque': config['actuator_torque'].value,
+        'elevator_torque': config['elevator_torque'].value,
+        'min_load': config['min_load'].value,
+    }
+
+class RVIKWorkspace(object):
+    '''Reusable scratch buffers for solveGeometry
+
+    Buffers are flat arrays which grow to fit the largest request made of
+    them, and are handed out as views of whatever shape is needed, so a
+    workspace serves full grids as well as smaller bands or compacted sets
+    of cells. The normalized goal grid for the workspace's (width, height)
+    is also computed once and kept.'''
+    def __init__(self, width=0, height=0, dtype=np.float64):
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.buffers = {}
+        self.unit_grid = None
+
+    def get(self, key, shape, dtype=None):
+        '''A scratch array of the given shape; contents are undefined'''
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = self.buffers.get((key, dtype))
+        if buf is None or buf.size < size:
+            buf = self.buffers[(key, dtype)] = np.empty(size, dtype)
+        return buf[:size].reshape(shape)
+
+    def unitGrid(self):
+        '''Goal grid coordinates in units of the grid step, as (x, y, norm)
+
+        Element [i, j] is the goal (i, height/2 - j); multiplying by the step
+        yields the goals (and goal distances) for a full-range solve.'''
+        if self.unit_grid is None:
+            shape = (self.width, self.height)
+            x = np.empty(shape, self.dtype)
+            y = np.empty(shape, self.dtype)
+            x[:] = np.arange(self.width)[:, np.newaxis]
+            y[:] = self.height/2 - np.arange(self.height)
+            norm = np.hypot(x, y)
+            self.unit_grid = (x, y, norm)
+        return self.unit_grid
+
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
+
+# Workspaces for full-range solves, keyed by grid shape and precision
+max_workspaces = 4
+workspaces = OrderedDict()
+
+def getWorkspace(width, height, dtype=np.float64):
+    '''The shared workspace for (width, height) grids of the given dtype'''
+    key = (width, height, np.dtype(dtype))
+    workspace = workspaces.get(key)
+    if workspace is None:
+        workspace = workspaces[key] = RVIKWorkspace(width, height, dtype)
+    workspaces.move_to_end(key)
+    while len(workspaces) > max_workspaces:
+        workspaces.popitem(last=False)
+    return workspace
+
+def solveGeometry(goals_x, goals_y, elevator_length, forearm_length, linkage_length,
+                  lower_actuator_length, upper_actuator_length,
+                  dists=None, workspace=None, out=None, **kwargs):
+    '''Solves the kinematic chain of the arm for arrays of goal points
+
+    goals_x and goals_y are the goal coordinates, of any (matching) shape.
+    Parameters may be scalars, or arrays which broadcast against the goals -
+    e.g. shape (N, 1, 1) to solve N configurations over N (width, height)
+    grids in a single pass. The goal distances may be given if known.
+
+    This is everything which depends only on the lengths of the arm. The
+    loads are then just the servo torques divided by the (absolute) load
+    denominators, so changes to torque or minimum load can be answered by
+    solveLoads alone. Any remaining (load) parameters are ignored.
+
+    All of the work is done in place, in scratch buffers from the workspace
+    (a private one, if not given), at the workspace's precision. The result
+    fields in geometry_fields are written to out (a dict of arrays) if
+    given, and are otherwise newly allocated. The other fields returned are
+    intermediates, which are views of the workspace and so only valid until
+    it is next used.'''
+    if workspace is None:
+        workspace = RVIKWorkspace()
+    dtype = workspace.dtype
+    E = np.asarray(elevator_length, dtype)
+    F = np.asarray(forearm_length, dtype)
+    A = np.asarray(linkage_length, dtype)
+    B = np.asarray(upper_actuator_length, dtype)
+    C = E
+    D = np.asarray(lower_actuator_length, dtype)
+    shape = np.broadcast(goals_x, goals_y, E, F, A, B, D).shape
+
+    # Scratch buffers are recycled as their contents fall out of use; the
+    # local names track what each one currently holds
+    buf = lambda i: workspace.get(i, shape)
+    mask = workspace.get('mask', shape, bool)
+    if out is None:
+        out = {
+            'actuator_den': np.empty(shape, dtype),
+            'elevator_den': np.empty(shape, dtype),
+            'partial_ok': np.empty(shape, bool),
+        }
+    ok = out['partial_ok']
+
+    if dists is None:
+        dists = buf(0)
+        np.hypot(goals_x, goals_y, out=dists)
+
+    # close enough for intersection
+    # intersect
+    a = buf(1)
+    np.multiply(dists, dists, out=a)
+    np.add(a, F**2 - E**2, out=a)
+    np.divide(a, dists, out=a)
+    np.multiply(a, 0.5, out=a)
+    h = buf(2)
+    np.multiply(a, a, out=h)
+    np.subtract(F**2, h, out=h)
+    np.sqrt(h, out=h)
+    p2_x = buf(3)
+    np.negative(goals_x, out=p2_x)
+    np.multiply(p2_x, a, out=p2_x)
+    np.divide(p2_x, dists, out=p2_x)
+    np.add(p2_x, goals_x, out=p2_x)
+    p2_y = buf(4)
+    np.negative(goals_y, out=p2_y)
+    np.multiply(p2_y, a, out=p2_y)
+    np.divide(p2_y, dists, out=p2_y)
+    np.add(p2_y, goals_y, out=p2_y)
+    # The offsets from p2 to the intersections are h/dist along the flipped
+    # (negated) goal vector
+    chunk_x = a
+    np.negative(goals_y, out=chunk_x)
+    np.multiply(chunk_x, h, out=chunk_x)
+    np.divide(chunk_x, dists, out=chunk_x)
+    chunk_y = h
+    np.multiply(h, goals_x, out=chunk_y)
+    np.negative(chunk_y, out=chunk_y)
+    np.divide(chunk_y, dists, out=chunk_y)
+    i1_x = buf(5)
+    np.add(p2_x, chunk_x, out=i1_x)
+    i1_y = buf(6)
+    np.subtract(p2_y, chunk_y, out=i1_y)
+    i2_x = p2_x
+    np.subtract(p2_x, chunk_x, out=i2_x)
+    i2_y = p2_y
+    np.add(p2_y, chunk_y, out=i2_y)
+    # Pick the higher solutions as the elbow points
+    np.greater(i1_y, i2_y, out=mask)
+    elbows_x = i2_x
+    np.copyto(elbows_x, i1_x, where=mask)
+    elbows_y = i2_y
+    np.copyto(elbows_y, i1_y, where=mask)
+
+    # Get the forearm vectors
+    forearm_x = buf(0)
+    np.subtract(goals_x, elbows_x, out=forearm_x)
+    forearm_y = buf(1)
+    np.subtract(goals_y, elbows_y, out=forearm_y)
+
+    # Need to calculate angle from vertical; can be negative
+    elevator_nx = buf(5)
+    np.divide(elbows_x, E, out=elevator_nx)
+    elevator_ny = buf(6)
+    np.divide(elbows_y, E, out=elevator_ny)
+    elevator_angles = buf(7)
+    np.arccos(elevator_ny, out=elevator_angles)
+    np.greater(elevator_nx, 0, out=mask)
+    np.negative(elevator_angles, out=elevator_angles, where=~mask)
+    # convert to servo setting
+    servos = buf(2)
+    np.degrees(elevator_angles, out=servos)
+    np.subtract(178.21, servos, out=servos)
+    np.greater(servos, 60, out=ok)
+    np.less(servos, 210, out=mask)
+    ok &= mask
+
+    forearm_dx = buf(8)
+    np.divide(forearm_x, F, out=forearm_dx)
+    forearm_dy = buf(9)
+    np.divide(forearm_y, F, out=forearm_dy)
+    forearm_angles = buf(10)
+    np.arccos(forearm_dy, out=forearm_angles)
+    np.greater(forearm_dx, 0, out=mask)
+    np.negative(forearm_angles, out=forearm_angles, where=~mask)
+
+    # Elevator-forearm angle (elbow angle)
+    elbow_angles = buf(2)
+    np.multiply(elevator_nx, forearm_dx, out=elbow_angles)
+    np.multiply(elevator_ny, forearm_dy, out=elevator_ny)
+    np.add(elbow_angles, elevator_ny, out=elbow_angles)
+    np.arccos(elbow_angles, out=elbow_angles)
+
+    # Base angles are between the elevators and actuators (NOT the forearms!)
+    # Repeated application of cosine rule yields the forearm angle
+    # Y is a diagonal across the irregular quatrilateral (opposite
+    # desired)
+    Ysq = buf(5)
+    np.cos(elbow_angles, out=Ysq)
+    np.multiply(Ysq, 2*C*B, out=Ysq)
+    np.subtract(C**2 + B**2, Ysq, out=Ysq)
+    Y = buf(6)
+    np.sqrt(Ysq, out=Y)
+    # foo and bar are the two angles adjacent to Y in the quat
+    foo = buf(11)
+    np.add(Ysq, D**2, out=foo)
+    np.subtract(foo, A**2, out=foo)
+    denom = buf(12)
+    np.multiply(Y, 2, out=denom)
+    np.multiply(denom, D, out=denom)
+    np.divide(foo, denom, out=foo)
+    np.clip(foo, -1, 1, out=foo)
+    np.arccos(foo, out=foo)
+    bar = buf(12)
+    np.add(Ysq, C**2, out=bar)
+    np.subtract(bar, B**2, out=bar)
+    denom = Ysq
+    np.multiply(Y, 2, out=denom)
+    np.multiply(denom, C, out=denom)
+    np.divide(bar, denom, out=bar)
+    np.clip(bar, -1, 1, out=bar)
+    np.arccos(bar, out=bar)
+    # together they form the angle between the elevator and actuator
+    base_angles = foo
+    np.add(foo, bar, out=base_angles)
+    # Actuator angles are then just the elevator - the base angle
+    actuator_angles = bar
+    np.subtract(elevator_angles, base_angles, out=actuator_angles)
+
+    # Constraints
+    degrees = buf(5)
+    # limit actuator servo angles
+    np.degrees(actuator_angles, out=degrees)
+    np.add(degrees, 204.78, out=degrees)
+    ok &= np.greater(degrees, 100, out=mask)
+    ok &= np.less(degrees, 250, out=mask)
+    # diff angle
+    np.degrees(base_angles, out=degrees)
+    ok &= np.greater(degrees, 44, out=mask)
+    ok &= np.less(degrees, 175, out=mask)
+    # forearm angle
+    np.degrees(forearm_angles, out=degrees)
+    ok &= np.greater(degrees, 80, out=mask)
+    ok &= np.less(degrees, 200, out=mask)
+    # elbow angle
+    np.degrees(elbow_angles, out=degrees)
+    ok &= np.greater(degrees, 10, out=mask)
+
+    # Load calculations
+    # Loads are calculated for the actuator and elevator servos, under the
+    # assumption of a static resting system where the other servo is holding
+    # steady.
+    x_p = B/1000
+    x_l = F/1000
+    x_e = E/1000
+    x_a = D/1000
+    # Direction components for lower actuator, used to find the moment of
+    # forces about it
+    lower_a_x = buf(2)
+    np.sin(actuator_angles, out=lower_a_x)
+    lower_a_y = buf(5)
+    np.cos(actuator_angles, out=lower_a_y)
+    # Linkage directions, from the upper to the lower actuator ends
+    upper = buf(6)
+    np.multiply(forearm_dx, x_p, out=upper)
+    linkage_x = buf(11)
+    np.divide(elbows_x, 1000, out=linkage_x)
+    np.subtract(linkage_x, upper, out=upper)
+    np.multiply(lower_a_x, x_a, out=linkage_x)
+    np.subtract(linkage_x, upper, out=linkage_x)
+    np.divide(linkage_x, A/1000, out=linkage_x)
+    np.multiply(forearm_dy, x_p, out=upper)
+    linkage_y = buf(13)
+    np.divide(elbows_y, 1000, out=linkage_y)
+    np.subtract(linkage_y, upper, out=upper)
+    np.multiply(lower_a_y, x_a, out=linkage_y)
+    np.subtract(linkage_y, upper, out=linkage_y)
+    np.divide(linkage_y, A/1000, out=linkage_y)
+    # Angles
+    alphas = linkage_x
+    np.multiply(linkage_x, forearm_dx, out=alphas)
+    np.multiply(linkage_y, forearm_dy, out=linkage_y)
+    np.add(alphas, linkage_y, out=alphas)
+    np.arccos(alphas, out=alphas)
+    np.subtract(alphas, np.pi/2, out=alphas)
+    thetas = buf(6)
+    np.subtract(forearm_angles, np.pi/2, out=thetas)
+    w = buf(13)
+    np.cos(thetas, out=w)
+    np.multiply(w, x_l, out=w)
+    denom = buf(14)
+    np.cos(alphas, out=denom)
+    np.multiply(denom, x_p, out=denom)
+    np.divide(w, denom, out=w)
+    theta_sums = thetas
+    np.add(thetas, alphas, out=theta_sums)
+    sin_theta_sums = alphas
+    np.sin(theta_sums, out=sin_theta_sums)
+    cos_theta_sums = theta_sums
+    np.cos(theta_sums, out=cos_theta_sums)
+    # Actuator: x_a * w * (cos_theta_sums*lower_a_x - sin_theta_sums*lower_a_y)
+    np.multiply(cos_theta_sums, lower_a_x, out=lower_a_x)
+    np.multiply(sin_theta_sums, lower_a_y, out=lower_a_y)
+    np.subtract(lower_a_x, lower_a_y, out=lower_a_x)
+    actuator_den = out['actuator_den']
+    np.multiply(w, x_a, out=actuator_den)
+    np.multiply(actuator_den, lower_a_x, out=actuator_den)
+    # Elevator: x_e * (w * sin_theta_sums * elevator_y - elevator_x * (w * cos_theta_sums + 1))
+    elevator_xy = buf(2)
+    np.cos(elevator_angles, out=elevator_xy)
+    np.multiply(w, sin_theta_sums, out=sin_theta_sums)
+    np.multiply(sin_theta_sums, elevator_xy, out=sin_theta_sums)
+    np.multiply(w, cos_theta_sums, out=cos_theta_sums)
+    np.add(cos_theta_sums, 1, out=cos_theta_sums)
+    np.sin(elevator_angles, out=elevator_xy)
+    np.multiply(elevator_xy, cos_theta_sums, out=cos_theta_sums)
+    elevator_den = out['elevator_den']
+    np.subtract(sin_theta_sums, cos_theta_sums, out=elevator_den)
+    np.multiply(elevator_den, x_e, out=elevator_den)
+    # We don't care about the direction of the torques
+    np.abs(actuator_den, out=actuator_den)
+    np.abs(elevator_den, out=elevator_den)
+
+    fields = {
+        'elbows_x': elbows_x,
+        'elbows_y': elbows_y,
+        'forearm_x': forearm_x,
+        'forearm_y': forearm_y,
+        'forearm_angles': forearm_angles,
+        'actuator_angles': actuator_angles,
+    }
+    fields.update(out)
+    return fields
+
+def annulusCells(dists, elevator_length, forearm_length, workspace):
+    '''Masks the goals which the arm can physically reach
+
+    Goals outside of |elevator - forearm| <= dist <= elevator + forearm have
+    no elbow position (the circles don't intersect), and solve to NaN and
+    unreachable regardless of the other parameters. The lengths may be
+    arrays, in which case the union of the annuli is masked.'''
+    inner = np.min(np.abs(np.subtract(elevator_length, forearm_length))) * (1 - annulus_margin)
+    outer = np.max(np.add(elevator_length, forearm_length)) * (1 + annulus_margin)
+    cells = workspace.get('annulus', dists.shape, bool)
+    np.greater_equal(dists, inner, out=cells)
+    cells &= np.less_equal(dists, outer, out=workspace.get('mask', dists.shape, bool))
+    return cells
+
+def solveCells(cells, goals_x, goals_y, dists, workspace, scale=None, **params):
+    '''solveGeometry for just the masked cells of a grid of goals
+
+    The cells are gathered into compact arrays (and multiplied by scale, if
+    given) and solved; returns the compact geometry fields (views of the
+    workspace), with any leading parameter axes of the solve kept. See
+    scatterCells.'''
+    cells = cells.ravel()
+    n = np.count_nonzero(cells)
+    compact = []
+    for name, field in (('cells_x', goals_x), ('cells_y', goals_y), ('cells_dist', dists)):
+        field = np.compress(cells, np.ravel(field), out=workspace.get(name, (n,)))
+        if scale is not None:
+            shape = np.broadcast(field, scale).shape
+            field = np.multiply(field, scale, out=workspace.get(name + '_scaled', shape))
+        compact.append(field)
+    shape = np.broadcast(compact[0], *[params[k] for k in length_params]).shape
+    out = {
+        'actuator_den': workspace.get('cells_actuator_den', shape),
+        'elevator_den': workspace.get('cells_elevator_den', shape),
+        'partial_ok': workspace.get('cells_partial_ok', shape, bool),
+    }
+    return solveGeometry(compact[0], compact[1], dists=compact[2],
+                         workspace=workspace, out=out, **params)
+
+def scatterCells(cells, compact, out):
+    '''Scatters compact geometry fields back over a grid (see solveCells)
+
+    Cells outside the mask take the values of an unreachable goal.'''
+    for k in geometry_fields:
+        out[k].fill(False if k == 'partial_ok' else np.nan)
+        np.place(out[k], cells, compact[k])
+
+def solveLoads(geometry, actuator_torque, elevator_torque, min_load, **kwargs):
+    '''Solves the loads and reachability for a solved geometry
+
+    This is just a rescaling of the geometry's load denominators, so costs
+    O(cells) with no trigonometry.'''
+    dtype = geometry['actuator_den'].dtype
+    actuator_loads = np.divide(np.asarray(abs(actuator_torque), dtype), geometry['actuator_den'])
+    elevator_loads = np.divide(np.asarray(abs(elevator_torque), dtype), geometry['elevator_den'])
+    loads = np.minimum(actuator_loads, elevator_loads)
+    reachable = np.greater(loads, min_load)
+    reachable &= geometry['partial_ok']
+    return {
+        'actuator_loads': actuator_loads,
+        'elevator_loads': elevator_loads,
+        'loads': loads,
+        'partial_ok': geometry['partial_ok'],
+        'reachable': reachable,
+    }
+
+def solveIK(goals, **params):
+    '''Solves the arm for an array of goal points of shape (..., 2)
+
+    Returns a dict of the geometry and load result fields (see
+    solveGeometry), each shaped like goals[..., 0].'''
+    goals = np.asarray(goals, dtype=float)
+    fields = solveGeometry(goals[..., 0], goals[..., 1], **params)
+    fields.update(solveLoads(fields, **params))
+    return fields
+
+def _acos(x):
+    '''math.acos, but NaN (as with np.arccos) outside of the domain'''
+    if -1 <= x <= 1:
+        return math.acos(x)
+    return math.nan
+
+def _sqrt(x):
+    if x >= 0:
+        return math.sqrt(x)
+    return math.nan
+
+def _div(a, b):
+    '''Division with NumPy's semantics for a zero divisor'''
+    if b == 0:
+        if a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1, b)
+    return a / b
+
+def solvePoint(config, point):
+    '''Solves the arm for a single goal point using scalar math
+
+    Returns the same dict as RVIK's point mode (point_results), with tuples
+    in place of vectors, but without any of the array overhead. The steps
+    mirror solveGeometry and solveLoads operation for operation.'''
+    p = ikParams(config)
+    E = float(p['elevator_length'])
+    F = float(p['forearm_length'])
+    A = float(p['linkage_length'])
+    B = float(p['upper_actuator_length'])
+    C = E
+    D = float(p['lower_actuator_length'])
+    gx = float(point[0])
+    gy = float(point[1])
+
+    dist = math.sqrt(gx*gx + gy*gy)
+    if dist == 0:
+        return {'ok': False}
+    # intersect
+    a = (F**2 - E**2 + dist**2) / (dist*2)
+    h = _sqrt(F**2 - a**2)
+    if math.isnan(h):
+        return {'ok': False}
+    p2x = gx + (a*(-gx)) / dist
+    p2y = gy + (a*(-gy)) / dist
+    chunk_x = h*(-gy) / dist
+    chunk_y = h*(-gx) / dist
+    # Pick the higher solution as the elbow point
+    if p2y - chunk_y > p2y + chunk_y:
+        elbow_x = p2x + chunk_x
+        elbow_y = p2y - chunk_y
+    else:
+        elbow_x = p2x - chunk_x
+        elbow_y = p2y + chunk_y
+    forearm_x = gx - elbow_x
+    forearm_y = gy - elbow_y
+
+    elevator_nx = elbow_x/E
+    elevator_ny = elbow_y/E
+    elevator_angle = _acos(elevator_ny) * (1 if elevator_nx > 0 else -1)
+    elevator_servo = (math.degrees(elevator_angle) - 178.21) * -1
+    forearm_dx = forearm_x/F
+    forearm_dy = forearm_y/F
+    forearm_angle = _acos(forearm_dy) * (1 if forearm_dx > 0 else -1)
+    elbow_angle = _acos(elevator_nx*forearm_dx + elevator_ny*forearm_dy)
+
+    Ysq = C**2 + B**2 - 2*C*B*math.cos(elbow_angle)
+    Y = _sqrt(Ysq)
+    cos_foo = min(max(_div(Ysq + D**2 - A**2, 2*Y*D), -1), 1)
+    cos_bar = min(max(_div(Ysq + C**2 - B**2, 2*Y*C), -1), 1)
+    base_angle = _acos(cos_foo) + _acos(cos_bar)
+    actuator_angle = elevator_angle - base_angle
+
+    actuator_servo = math.degrees(actuator_angle) + 204.78
+    base_degrees = math.degrees(base_angle)
+    forearm_degrees = math.degrees(forearm_angle)
+    partial_ok = (60 < elevator_servo < 210 and
+                  100 < actuator_servo < 250 and
+                  44 < base_degrees < 175 and
+                  80 < forearm_degrees < 200 and
+                  math.degrees(elbow_angle) > 10)
+
+    lower_a_x = math.sin(actuator_angle)
+    lower_a_y = math.cos(actuator_angle)
+    if partial_ok:
+        x_p = B/1000
+        x_l = F/1000
+        x_e = E/1000
+        x_a = D/1000
+        linkage_x = (lower_a_x * x_a - (elbow_x/1000 - x_p * forearm_dx)) / (A/1000)
+        linkage_y = (lower_a_y * x_a - (elbow_y/1000 - x_p * forearm_dy)) / (A/1000)
+        theta = forearm_angle - math.pi/2
+        alpha = _acos(linkage_x*forearm_dx + linkage_y*forearm_dy) - math.pi/2
+        w = _div(x_l * math.cos(theta), x_p * math.cos(alpha))
+        theta_sum = theta + alpha
+        sin_theta_sum = math.sin(theta_sum)
+        cos_theta_sum = math.cos(theta_sum)
+        actuator_den = abs(x_a * w * (cos_theta_sum*lower_a_x - sin_theta_sum*lower_a_y))
+        z = w * sin_theta_sum * math.cos(elevator_angle) - math.sin(elevator_angle) * (w * cos_theta_sum + 1)
+        elevator_den = abs(x_e * z)
+        actuator_load = _div(abs(p['actuator_torque']), actuator_den)
+        elevator_load = _div(abs(p['elevator_torque']), elevator_den)
+        if math.isnan(actuator_load) or math.isnan(elevator_load):
+            load = math.nan
+        else:
+            load = min(actuator_load, elevator_load)
+    if not (partial_ok and load > p['min_load']):
+        return {'ok': False}
+
+    # Package up the point's results
+    lower_actuator = (D * lower_a_x, D * lower_a_y)
+    forearm_norm = math.sqrt(forearm_x*forearm_x + forearm_y*forearm_y)
+    upper_actuator = (elbow_x - B * forearm_x / forearm_norm,
+                      elbow_y - B * forearm_y / forearm_norm)
+    L = (0, -load)
+    # Divide by 1000 to convert units from mm to M
+    x_p = B/1000
+    x_l = F/1000
+    theta = forearm_angle - math.pi/2
+    linkage_x = lower_actuator[0] - upper_actuator[0]
+    linkage_y = lower_actuator[1] - upper_actuator[1]
+    linkage_norm = math.sqrt(linkage_x*linkage_x + linkage_y*linkage_y)
+    forearm_dir_x = forearm_x/forearm_norm
+    forearm_dir_y = forearm_y/forearm_norm
+    alpha = _acos(linkage_x/linkage_norm*forearm_dir_x + linkage_y/linkage_norm*forearm_dir_y) - math.pi/2
+    m_p = -(x_l * load * math.cos(theta))/(x_p * math.cos(alpha))
+    P = (math.sin(theta + alpha) * m_p, math.cos(theta + alpha) * m_p)
+    return {
+        'ok' : True,
+        'elbow_pos' : (elbow_x, elbow_y),
+        'goal_pos' : (gx, gy),
+        'lower_actuator' : lower_actuator,
+        'upper_actuator' : upper_actuator,
+        'P': P,
+        'L': L,
+        'F': (-(P[0] + L[0]), -(P[1] + L[1])),
+        'load': load,
+    }
+
+def gridDomain(resolution, dtype=np.float64):
+    '''The goal domain of a full-range solve (see geometryKey)'''
+    dtype = np.dtype(dtype)
+    if dtype == np.float64:
+        return resolution
+    return (resolution, dtype.name)
+
+def geometryKey(params, domain):
+    '''Identifies the geometry of a solve: its lengths and goal domain'''
+    return (domain,) + tuple(float(params[key]) for key in length_params)
+
+class RVGeometryCache(object):
+    '''Bounded LRU cache of solved geometry, keyed by geometryKey
+
+    Each process has its own (see geometry_cache); jobs which share lengths
+    with a recent job then skip straight to the load stage.'''
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Returns the cached geometry for key, or None'''
+        geometry = self.entries.get(key)
+        if geometry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return geometry
+
+    def put(self, key, geometry):
+        self.entries[key] = geometry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def resize(self, size):
+        self.size = size
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'size': self.size,
+        }
+
+# Per-process geometry cache, used by the pool workers
+geometry_cache = RVGeometryCache()
+# Per-process cache of viewport tile geometry; tiles are small, so many are
+# kept. The pool can't pick which worker runs a job, so a region solved
+# before only hits the cache if it lands on a worker which solved it
+tile_cache = RVGeometryCache(size=512)
+
+def viewportRegion(rect, pixel_size, max_dist):
+    '''The tile-aligned region to solve for a view of the scene
+
+    rect is the visible (x0, y0, x1, y1) scene rectangle, and pixel_size the
+    scene size of a screen pixel. The cell step is the largest power of two
+    no bigger than a pixel, so that zooming only changes it at whole octaves
+    and tiles stay reusable. Only the part of the view which the arm could
+    reach (within max_dist) is covered. Returns a region for RVIK, i.e.
+    (step, first tile x, first tile y, tiles across, tiles down), or None if
+    nothing in view is within reach.
+
+    Tiles are cached per process (see tile_cache), so panning back over an
+    area reuses its tiles only when the solve lands on the same pool worker
+    as before; otherwise they're solved again.'''
+    x0 = max(rect[0], 0)
+    x1 = min(rect[2], max_dist)
+    y0 = max(rect[1], -max_dist)
+    y1 = min(rect[3], max_dist)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    step = 2.0**math.floor(math.log2(pixel_size))
+    while True:
+        span = tile_cells*step
+        # Tile rows run downwards, from y = -tile_y*span
+        tile_x = int(math.floor(x0/span))
+        tile_y = int(math.floor(-y1/span))
+        tiles_x = int(math.ceil(x1/span)) - tile_x
+        tiles_y = int(math.ceil(-y0/span)) - tile_y
+        if tiles_x*tiles_y*tile_cells**2 <= max_region_cells:
+            return (step, tile_x, tile_y, tiles_x, tiles_y)
+        step *= 2
+
+def findContours(ok, origin, step):
+    '''Contour-maps a reachable region, returning contours in scene units
+
+    Cell [i, j] of the region lies at ((i + origin[0])*step, (origin[1] - j)*step)'''
+    im2, contours, hierarchy = cv2.findContours(ok.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) > 0:
+        return [(contour - [origin[1], -origin[0]]) * step for contour in contours]
+    else:
+        return None
+
+def sampleLoads(iks, points, interpolate=False):
+    '''Samples the reachable loads of many IK solutions at many points
+
+    Returns an array of shape (len(iks), ...) for points of shape (..., 2);
+    missing (None) solutions sample as zero. See RVIK.sampleLoads.'''
+    points = np.asarray(points, dtype=float)
+    samples = np.zeros((len(iks),) + points.shape[:-1])
+    for i, ik in enumerate(iks):
+        if ik is not None:
+            samples[i] = ik.sampleLoads(points, interpolate)
+    return samples
+
+def blendIK(ik0, ik1, t, config):
+    '''Approximates a full-range solution lying between two others
+
+    The geometry fields of two solutions at the same resolution are blended
+    cell by cell, and the loads evaluated for config. Grids are in units of
+    the arm's reach, so line up closely for nearby configurations. Meant
+    for previews; the result is never taken to be config's exact geometry.'''
+    geometry = {}
+    for k in ('actuator_den', 'elevator_den'):
+        geometry[k] = (1 - t)*ik0.geometry[k] + t*ik1.geometry[k]
+    geometry['partial_ok'] = (ik0 if t < 0.5 else ik1).geometry['partial_ok']
+    geometry['key'] = ('blend', ik0.geometry['key'], ik1.geometry['key'], t)
+    ik = RVIK(resolution=ik0.resolution, geometry=geometry, dtype=ik0.dtype)
+    ik.config = config
+    ik.params = params = ikParams(config)
+    ik.width = ik0.width
+    ik.height = ik0.height
+    ik.scaling_factor = (params['elevator_length'] + params['forearm_length'])/ik.resolution
+    ik.origin = ik0.origin
+    ik.domain = ik0.domain
+    ik.solved_cells = 0
+    ik.approximate = True
+    ik.invalidate('geometry')
+    return ik
+
+def solveTile(params, step, tile_x, tile_y, dtype=np.float64):
+    '''Solves the retained geometry fields for a single viewport tile'''
+    shape = (tile_cells, tile_cells)
+    workspace = getWorkspace(tile_cells, tile_cells, dtype)
+    # Goals are integral multiples of the step, so agree between tiles
+    goals_x = workspace.get('goals_x', shape)
+    goals_y = workspace.get('goals_y', shape)
+    goals_x[...] = ((tile_x*tile_cells + np.arange(tile_cells))*step)[:, np.newaxis]
+    goals_y[...] = -(tile_y*tile_cells + np.arange(tile_cells))*step
+    dists = np.hypot(goals_x, goals_y, out=workspace.get('dists', shape))
+    geometry = {
+        'actuator_den': np.empty(shape, dtype),
+        'elevator_den': np.empty(shape, dtype),
+        'partial_ok': np.empty(shape, bool),
+    }
+    cells = annulusCells(dists, params['elevator_length'], params['forearm_length'], workspace)
+    compact = solveCells(cells, goals_x, goals_y, dists, workspace, **params)
+    scatterCells(cells, compact, geometry)
+    return geometry
+
+def bandRows(height, dtype=np.float64, memory_budget=default_memory_budget):
+    '''Rows per band of a banded solve, keeping within a scratch memory budget'''
+    row_bytes = height * band_cell_fields * np.dtype(dtype).itemsize
+    return max(1, int(memory_budget // row_bytes))
+
+def solveBand(params, resolution, start, stop, dtype=np.float64, prune=True,
+              workspace=None, out=None):
+    '''Solves the retained geometry fields for rows [start, stop) of a grid
+
+    This is a full-range solve of the given resolution, restricted to a band
+    of rows, with scratch memory proportional to the band rather than the
+    grid (see bandRows). The results match the same rows of a full solve.'''
+    dtype = np.dtype(dtype)
+    height = 2*resolution
+    shape = (stop - start, height)
+    if workspace is None:
+        workspace = getWorkspace(stop - start, height, dtype)
+    step = dtype.type((params['elevator_length'] + params['forearm_length']) / resolution)
+    # As in RVIKWorkspace.unitGrid, but for just the band
+    unit_x = workspace.get('unit_x', shape)
+    unit_y = workspace.get('unit_y', shape)
+    unit_x[...] = np.arange(start, stop)[:, np.newaxis]
+    unit_y[...] = height/2 - np.arange(height)
+    dists = np.hypot(unit_x, unit_y, out=workspace.get('dists', shape))
+    np.multiply(dists, step, out=dists)
+    goals_x = np.multiply(unit_x, step, out=unit_x)
+    goals_y = np.multiply(unit_y, step, out=unit_y)
+    if out is None:
+        out = {
+            'actuator_den': np.empty(shape, dtype),
+            'elevator_den': np.empty(shape, dtype),
+            'partial_ok': np.empty(shape, bool),
+        }
+    if prune:
+        cells = annulusCells(dists, params['elevator_length'], params['forearm_length'], workspace)
+        compact = solveCells(cells, goals_x, goals_y, dists, workspace, **params)
+        scatterCells(cells, compact, out)
+    else:
+        solveGeometry(goals_x, goals_y, dists=dists, workspace=workspace, out=out, **params)
+    return out
+
+def solveTiled(config, resolution, pool=None, memory_budget=default_memory_budget,
+               dtype=np.float64, priority=priority_main):
+    '''Solves the full range at high resolution in memory-bounded bands
+
+    Scratch memory stays within memory_budget however high the resolution;
+    only the result fields themselves grow with it. If a pool is given the
+    bands are solved across its processes (each keeping to the budget) and
+    this blocks until they're all in. The bands are stitched together before
+    contour-mapping, so contours run straight across the seams. Returns the
+    RVIK solution.'''
+    params = ikParams(config)
+    height = 2*resolution
+    rows = bandRows(height, dtype, memory_budget)
+    ik = RVIK(resolution=resolution, dtype=dtype, memory_budget=memory_budget)
+    if pool is None:
+        ik.setConfig(config)
+        return ik
+    geometry = {
+        'actuator_den': np.empty((resolution, height), dtype),
+        'elevator_den': np.empty((resolution, height), dtype),
+        'partial_ok': np.empty((resolution, height), bool),
+    }
+    remaining = set()
+    def receive(band, start, stop):
+        for k in geometry_fields:
+            geometry[k][start:stop] = band[k]
+        remaining.discard(start)
+    for start in range(0, resolution, rows):
+        stop = min(start + rows, resolution)
+        remaining.add(start)
+        pool.registerJob(solveBand, [params, resolution, start, stop, dtype],
+                         priority=priority,
+                         callback=lambda band, start=start, stop=stop: receive(band, start, stop))
+    pool.wait(lambda: len(remaining) == 0)
+    if len(remaining) > 0:
+        raise Exception('Tiled solve failed for rows starting {0}'.format(sorted(remaining)))
+    geometry['key'] = geometryKey(params, gridDomain(resolution, dtype))
+    ik.geometry = geometry
+    ik.setConfig(config)
+    return ik
+
+def solveBatch(configs, resolution=100, chunk_size=None, cache=None, dtype=np.float64, prune=True):
+    '''Solves the full range of many configurations at once
+
+    Configurations are stacked along a leading axis and their geometry solved
+    in a single broadcasted pass (or one pass per chunk of chunk_size
+    configurations, to cap memory use). Configurations sharing lengths share
+    a geometry, and if a cache is given any geometry found there is reused.
+    With prune, only cells within reach of some configuration in the pass
+    are solved (see annulusCells). Returns a list of RVIK results, one per
+    config.'''
+    width = resolution
+    height = 2*width
+    # Private to the batch, as its buffers are sized for whole chunks
+    workspace = RVIKWorkspace(width, height, dtype)
+    unit_x, unit_y, unit_norm = workspace.unitGrid()
+    domain = gridDomain(resolution, dtype)
+    if chunk_size is None:
+        chunk_size = max(1, len(configs))
+    results = []
+    for start in range(0, len(configs), chunk_size):
+        chunk = configs[start:start + chunk_size]
+        params = [ikParams(config) for config in chunk]
+        keys = [geometryKey(p, domain) for p in params]
+        # Find the distinct geometries which still need solving
+        geometries = {}
+        missing = []
+        for key, p in zip(keys, params):
+            if key in geometries:
+                continue
+            geometries[key] = cache.get(key) if cache is not None else None
+            if geometries[key] is None:
+                missing.append((key, p))
+        if len(missing) > 0:
+            stacked = {}
+            for name in length_params:
+                stacked[name] = np.array([p[name] for key, p in missing], dtype=dtype).reshape(-1, 1, 1)
+            # The maximum possible distance
+            steps = (stacked['elevator_length'] + stacked['forearm_length']) / resolution
+            if prune:
+                # Masked in units of the grid step, which differs per config
+                cells = annulusCells(unit_norm, stacked['elevator_length'] / steps,
+                                     stacked['forearm_length'] / steps, workspace)
+                flat = {k: v.reshape(-1, 1) for k, v in stacked.items()}
+                compact = solveCells(cells, unit_x, unit_y, unit_norm, workspace,
+                                     scale=steps.reshape(-1, 1), **flat)
+            else:
+                fields = solveGeometry(unit_x * steps, unit_y * steps,
+                                       dists=unit_norm * steps,
+                                       workspace=workspace, **stacked)
+            for i, (key, p) in enumerate(missing):
+                if prune:
+                    geometry = {
+                        'actuator_den': np.empty((width, height), dtype),
+                        'elevator_den': np.empty((width, height), dtype),
+                        'partial_ok': np.empty((width, height), bool),
+                    }
+                    scatterCells(cells, {k: compact[k][i] for k in geometry_fields}, geometry)
+                else:
+                    geometry = {name: fields[name][i] for name in geometry_fields}
+                geometry['key'] = key
+                geometries[key] = geometry
+                if cache is not None:
+                    cache.put(key, geometry)
+        for config, key in zip(chunk, keys):
+            ik = RVIK(resolution=resolution, geometry=geometries[key], dtype=dtype)
+            ik.setConfig(config)
+            results.append(ik)
+    return results
 
 
 class RVIK(object):
-    def __init__(self, config = None, resolution = None, point = None):
+    def __init__(self, config = None, resolution = None, point = None, geometry = None, cache = None, cancel = None, dtype = None, prune = True, adaptive = None, region = None, memory_budget = None):
         self.point_results = None
+        self.profile = 'full'
+        # Evaluated fields, in the order they were evaluated in
+        self.field_order = OrderedDict()
+        self.field_budget = field_memory_budget
+        # Working precision; float32 halves memory use at some cost in
+        # accuracy near the edges of the reachable region
+        self.dtype = np.dtype(dtype if dtype is not None else np.float64)
+        # Solve only the cells within reach of the arm (see annulusCells)
+        self.prune = prune
+        # Coarse grid step for adaptive solves (see solveAdaptiveGeometry)
+        if adaptive is not None and (adaptive < 2 or adaptive & (adaptive - 1)):
+            raise Exception('Adaptive step must be a power of two, not {0}'.format(adaptive))
+        self.adaptive = adaptive
+        # Whether the loads are estimated for some cells rather than solved
+        # (adaptive solves, and blends; see blendIK)
+        self.approximate = adaptive is not None
+        # Number of cells actually solved by the last full-range solve
+        self.solved_cells = None
+        # Scratch memory budget for full-range solves, in bytes; if set the
+        # grid is solved in bands which fit within it (see bandRows)
+        self.memory_budget = memory_budget
+        # Viewport region to solve instead of the full range; see
+        # viewportRegion. Its geometry is solved (and cached) tile by tile,
+        # in the given cache, which is only ever local to this process
+        self.region = region
+        # Geometry stage results, reused for as long as the lengths (and goal
+        # domain) stay the same - see solveGeometry
+        self.geometry = geometry
         if resolution is not None:
             self.resolution = resolution
         else:
             self.resolution = 100
-            if point is not None:
-                self.point_mode = True
-                self.point = point
-            else:
-                self.point_mode = False
+        if point is not None:
+            self.point_mode = True
+            self.point = point
+        else:
+            self.point_mode = False
         if config is not None:
-            self.setConfig(config)
+            self.setConfig(config, cache, cancel)
 
     def setPoint(self, point):
         '''Sets a goal point to solve for, rather than solving the full range'''
@@ -92,247 +1251,467 @@ class RVIK(object):
         self.point = point
         self.calculate()
 
-    def setConfig(self, config):
+    def setConfig(self, config, cache=None, cancel=None):
         '''Set the configuration for the solver, and recalculate the IK solution set'''
         self.config = config
-        self.calculate()
+        self.calculate(cache, cancel)
 
     def adjust(self, param, val):
-        '''Perform a partial recalculation with an adjusted parameter'''
-        if param == 'min_load':
-            load_ok = self.loads > val
-            self.reachable = self.partial_ok*load_ok
+        '''Perform a partial recalculation with an adjusted load parameter
+
+        Only the load stage is recalculated, against the cached geometry.'''
+        if self.geometry is None:
+            raise Exception('Cannot adjust a solution stripped to the {0} profile'.format(self.profile))
+        if param in load_params:
+            self.params[param] = val
+            self.invalidate(param)
+            if self.point_mode:
+                self.packagePoint(self.geometry)
         else:
             raise Exception('Unsupported parameter for IK adjust {0}'.format(param))
 
     def sampleLoad(self, point):
-        x = int(point[0] / self.scaling_factor)
-        y = int(self.height/2 - point[1]/self.scaling_factor)
-        if x >= self.loads.shape[0] or y >= self.loads.shape[1] or x < 0 or y < 0:
-            return 0
-        if self.reachable[x, y]:
-            return self.loads[x, y]
-        return 0
+        return self.sampleLoads(point)[()]
+
+    def sampleLoads(self, points, interpolate=False):
+        '''Vectorized sampleLoad, for an array of points of shape (..., 2)
+
+        Points outside the grid, or unreachable, sample as zero. With
+        interpolate, loads are bilinearly interpolated between the four
+        surrounding cells (with unreachable cells counting as zero). Samples
+        of an approximate solution are only estimates (see approximate).'''
+        points = np.asarray(points, dtype=float)
+        # Fractional cell coordinates
+        x = points[..., 0] / self.scaling_factor - self.origin[0]
+        y = self.origin[1] - points[..., 1]/self.scaling_factor
+        if not interpolate:
+            # Truncation matches the int() conversion in sampleLoad
+            return self.sampleCells(np.trunc(x), np.trunc(y))
+        x0 = np.floor(x)
+        y0 = np.floor(y)
+        tx = x - x0
+        ty = y - y0
+        return ((1 - tx) * (1 - ty) * self.sampleCells(x0, y0) +
+                tx * (1 - ty) * self.sampleCells(x0 + 1, y0) +
+                (1 - tx) * ty * self.sampleCells(x0, y0 + 1) +
+                tx * ty * self.sampleCells(x0 + 1, y0 + 1))
+
+    def strip(self, profile):
+        '''Drops everything the given result profile doesn't need
+
+        'outline' keeps the contours and valid_points (along with the plain
+        attributes, e.g. config and scaling_factor). 'loads' also keeps the
+        sample field, enough for sampleLoads. Every other result field is
+        dropped, and raises if asked for; the geometry is gone too, so a
+        stripped solution can't be adjusted. 'full' keeps everything.'''
+        if profile not in result_profiles:
+            raise Exception('Unknown result profile {0}'.format(profile))
+        self.profile = profile
+        if self.point_mode:
+            return self
+        # Evaluate whatever the profile keeps before anything is dropped
+        self.contours
+        self.valid_points
+        if profile == 'full':
+            self.loads
+            self.reachable
+            return self
+        stripped = ['actuator_loads', 'elevator_loads', 'loads', 'partial_ok',
+                    'reachable', 'valid_indices']
+        if profile == 'loads':
+            self.sample_field
+        else:
+            stripped.append('sample_field')
+        self.geometry = None
+        # Removed outright, so asking for one raises (see __getattr__)
+        for name in stripped:
+            self.__dict__.pop(name, None)
+            self.field_order.pop(name, None)
+        return self
+
+    def sampleCells(self, x, y):
+        '''Looks up the sample field at integral cell coordinates'''
+        width, height = self.sample_field.shape
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        x = np.where(inside, x, 0).astype(int)
+        y = np.where(inside, y, 0).astype(int)
+        return np.where(inside, self.sample_field[x, y], 0)
 
     # @profile
-    def calculate(self):
-        '''Calculates the set of IK solutions, revealing the reachable area'''
-        # Config
-        elevator_length = self.config['elevator_length'].value
-        forearm_length = self.config['forearm_length'].value
-        linkage_length = self.config['linkage_length'].value
-        lower_actuator_length = self.config['lower_actuator_length'].value
-        upper_actuator_length = self.config['upper_actuator_length'].value
-        wrist_length = self.config['wrist_length'].value
-        actuator_torque = self.config['actuator_torque'].value
-        elevator_torque = self.config['elevator_torque'].value
-        min_load = self.config['min_load'].value
+    def calculate(self, cache=None, cancel=None):
+        '''Calculates the set of IK solutions, revealing the reachable area
+
+        A geometry cache (see RVGeometryCache) may be given to look up and
+        store the geometry stage in. If a cancel function is given, the
+        geometry is solved in bands of rows, and RVJobCancelled is raised as
+        soon as cancel() returns True.'''
+        self.params = params = ikParams(self.config)
 
         # Generate goals (or just use point mode)
         if self.point_mode:
-            goals = np.array([[self.point]])
+            domain = ('point', float(self.point[0]), float(self.point[1]))
             self.width = 1
             self.height = 1
+        elif self.region is not None:
+            step, tile_x, tile_y, tiles_x, tiles_y = self.region
+            domain = ('region', self.region, self.dtype.name)
+            self.width = tiles_x*tile_cells
+            self.height = tiles_y*tile_cells
+            self.scaling_factor = step
+            # The scene position of cell [0, 0], in cells
+            self.origin = (tile_x*tile_cells, -tile_y*tile_cells)
         else:
             # The maximum possible distance
-            max_dist = elevator_length + forearm_length
+            max_dist = params['elevator_length'] + params['forearm_length']
+            domain = gridDomain(self.resolution, self.dtype)
+            if self.adaptive:
+                # Refinement follows the reachable boundary, so depends on
+                # the loads as well as the lengths
+                domain = (domain, 'adaptive', self.adaptive,
+                          tuple(float(params[k]) for k in load_params))
             self.width = self.resolution
             self.height = 2*self.width
-            step = max_dist/self.resolution
-            x = np.arange(self.width) * step
-            y = (self.height / 2 - np.arange(self.height)) * step
-            self.scaling_factor = step
-            goals = np.dstack(np.meshgrid(y, x))[:,:,::-1]
-
-        dists = np.linalg.norm(goals, axis=2)
-
-        # close enough for intersection
-        # intersect
-        stack_dists = np.dstack([dists,dists])
-        a = (forearm_length**2 - elevator_length**2 + dists**2) / (dists*2)
-        h = np.sqrt(forearm_length**2 - a**2)
-        p2 = goals + (np.dstack([a,a])*(-goals)) / stack_dists
-        i1 = np.array(p2)
-        # [:, :, ::-1] flips x and y coords
-        # dstack is a lazy way to get the scalar h/dists to multiply across the vectors
-        # - it just doubles up the scalar to e.g. [h, h] so becomes [h,h]*[xi,yi]
-        stack_h = np.dstack([h,h])
-        flipped_goals = (-goals)[:,:,::-1]
-        i_chunk = stack_h * flipped_goals / stack_dists
-        i1 += [1,-1] * i_chunk
-        i2 = np.array(p2)
-        i2 += [-1,1] * i_chunk
-        # Pick the higher solutions as the elbow points
-        # elbows = np.zeros((self.width, self.height, 2))
-        # for j in range(self.height):
-        #     for i in range(self.width):
-        #         if i1[i, j, 1] > i2[i, j, 1]:
-        #             elbows[i, j] = i1[i, j]
-        #         else:
-        #             elbows[i, j] = i2[i, j]
-        i1_greater = i1[:,:,1] > i2[:,:,1]
-        i1_greater = np.dstack([i1_greater, i1_greater])
-        i2_greater = ~ i1_greater
-        elbows = i1_greater * i1 + i2_greater * i2
-
-        # Get the elevator and forearm vectors
-        elevator_vecs = elbows
-        forearm_vecs = goals - elbows
-        elbows = np.ma.masked_array(elbows, np.isnan(elbows))
-        # goals = np.ma.masked_array(goals, elbows.mask)
-
-        # Show the elevator/forearm angle
-        # Need to calculate angle from vertical; can be negative
-        vertical = np.array([0,1])
-        horizontal = np.array([1,0])
-        elevator_norms = elevator_vecs/elevator_length
-        vdots = np.inner(elevator_norms, vertical)
-        hdots = np.inner(elevator_norms, horizontal)
-        elevator_angles = np.arccos(vdots) * ((hdots > 0)*2 - 1)
-        # convert to servo setting
-        elevator_servos = (np.degrees(elevator_angles) - 178.21) * -1
-        # hacky but it works - divide by zero to clear out-of-range areas
-        elevator_servos /= (np.logical_and(elevator_servos > 60, elevator_servos < 210)*1)
-
-        forearm_dirs = forearm_vecs/forearm_length
-        vdots = np.inner(forearm_dirs, vertical)
-        hdots = np.inner(forearm_dirs, horizontal)
-        forearm_angles = np.arccos(vdots) * ((hdots > 0)*2 - 1)
-        elevator_ok = (np.logical_and(elevator_servos > 60, elevator_servos < 210)*1)
-        forearm_ok = (np.logical_and(forearm_angles > 0, forearm_angles < 180)*1)
-
-        # Elevator-forearm angle (elbow angle)
-        # Element-wise dot product
-        elbow_angles = np.arccos(np.einsum("ijk, ijk -> ij", elevator_norms, forearm_dirs))
-
-        # Base angles are between the elevators and actuators (NOT the forearms!)
-        A = linkage_length
-        B = upper_actuator_length
-        C = elevator_length
-        D = lower_actuator_length
-        # Repeated application of cosine rule yields the forearm angle
-        # Y is a diagonal across the irregular quatrilateral (opposite
-        # desired)
-        Ysq = C**2 + B**2 - 2*C*B*np.cos(elbow_angles)
-        Y = np.sqrt(Ysq)
-        # foo and bar are the two angles adjacent to Y in the quat
-        cosFoo = np.clip((Ysq + D**2 - A**2) / (2*Y*D), -1, 1)
-        cosBar = np.clip((Ysq + C**2 - B**2) / (2*Y*C), -1, 1)
-        foo = np.arccos(cosFoo)
-        bar = np.arccos(cosBar)
-        # together they form the angle between the elevator and actuator
-        base_angles = foo + bar
-        # Actuator angles are then just the elevator - the base angle
-        actuator_angles = elevator_angles - base_angles
-
-        # Constraints
-        # limit actuator servo angles
-        actuator_servos = (np.degrees(actuator_angles) + 204.78)
-        actuator_ok = (actuator_servos > 100)*1 * (actuator_servos < 250)*1
-        # diff angle
-        base_ok = (np.degrees(base_angles) > 44)*1 *(np.degrees(base_angles) < 175)*1
-        # forearm angle
-        forearm_ok = (np.degrees(forearm_angles) > 80)*1 * (np.degrees(forearm_angles) < 200)*1
-        # elbow angle
-        elbow_ok = (np.degrees(elbow_angles) > 10)*1
-
-
-        # Load calculations
-        # Loads are calculated for the actuator and elevator servos, under the
-        # assumption of a static resting system where the other servo is holding
-        # steady.
-        x_p = upper_actuator_length/1000
-        x_l = forearm_length/1000
-        x_e = elevator_length/1000
-        x_a = lower_actuator_length/1000
-        # Direction components for lower actuator and elevator, used to find
-        # the moment of forces about these sections
-        lower_a_x = np.sin(actuator_angles)
-        lower_a_y = np.cos(actuator_angles)
-        elevator_x = np.sin(elevator_angles)
-        elevator_y = np.cos(elevator_angles)
-        a = np.dstack([lower_a_x, lower_a_y])
-        lower_actuators = a * x_a
-        upper_actuators = elbows/1000 - x_p * forearm_dirs
-        linkage_vecs = lower_actuators - upper_actuators
-        linkage_dirs = linkage_vecs / (linkage_length/1000)
-        # Angles
-        thetas = forearm_angles - np.pi/2
-        cos_alphas = np.einsum("ijk, ijk -> ij", linkage_dirs, forearm_dirs)
-        alphas = np.arccos(cos_alphas) - np.pi/2
-        w = (x_l * np.cos(thetas)) / (x_p * np.cos(alphas))
-        theta_sums = thetas + alphas
-        sin_theta_sums = np.sin(theta_sums)
-        cos_theta_sums = np.cos(theta_sums)
-        actuator_loads = actuator_torque / (x_a * w * (cos_theta_sums*a[:,:,0] - sin_theta_sums*a[:,:,1]))
-        z = w * sin_theta_sums * elevator_y - elevator_x * (w * cos_theta_sums + 1)
-        elevator_loads = elevator_torque / (x_e * z)
-        # We don't care about the direction of the torques
-        actuator_loads = np.abs(actuator_loads)
-        elevator_loads = np.abs(elevator_loads)
-        loads = np.minimum(actuator_loads, elevator_loads)
-        self.actuator_loads = actuator_loads
-        self.elevator_loads = elevator_loads
-        self.loads = loads
-
-        load_ok = loads > min_load
-        self.partial_ok = elevator_ok*forearm_ok*actuator_ok*base_ok*forearm_ok*elbow_ok
-        ok = self.partial_ok*load_ok
-        self.reachable = ok
+            self.scaling_factor = max_dist/self.resolution
+            self.origin = (0, self.height/2)
+
+        # Only the load stage needs redoing if the geometry is unchanged
+        self.domain = domain
+        key = geometryKey(params, domain)
+        # The cache holds the tiles of a region, rather than the region itself
+        whole_cache = cache if self.region is None else None
+        if (self.geometry is None or self.geometry['key'] != key) and whole_cache is not None:
+            self.geometry = whole_cache.get(key)
+        if self.geometry is None or self.geometry['key'] != key:
+            if self.point_mode:
+                goals_x = np.full((1, 1), self.point[0], self.dtype)
+                goals_y = np.full((1, 1), self.point[1], self.dtype)
+                # A private workspace, as the intermediates are kept
+                workspace = RVIKWorkspace(1, 1, self.dtype)
+                geometry = solveGeometry(goals_x, goals_y, workspace=workspace, **params)
+            elif self.region is not None:
+                geometry = self.solveRegionGeometry(params, cache, cancel)
+            elif self.adaptive:
+                geometry = self.solveAdaptiveGeometry(params, cancel)
+            else:
+                geometry = self.solveGridGeometry(params, cancel)
+                self.solved_cells = self.width*self.height
+            geometry['key'] = key
+            self.geometry = geometry
+            if whole_cache is not None:
+                whole_cache.put(key, geometry)
 
+        if cancel is not None and cancel():
+            raise RVJobCancelled()
+        # Everything else is evaluated as it's asked for
+        self.invalidate('geometry')
         if self.point_mode:
-            # In point mode we just package up the point's results
-            # Calculate the actuator vector
-            a = actuator_angles[0,0]
-            lower_actuator = lower_actuator_length * np.array([np.sin(a), np.cos(a)])
-            forearm = forearm_vecs[0,0]
-            upper_actuator = elbows[0,0] - upper_actuator_length * forearm / np.linalg.norm(forearm)
-            if ok[0,0]:
-                # say load is 20N
-                l = loads[0,0]
-                L = np.array([0, -l])
-                # Divide by 1000 to convert units from mm to M
-                x_p = upper_actuator_length/1000
-                x_l = forearm_length/1000
-                x_e = elevator_length/1000
-                x_a = lower_actuator_length/1000
-                theta = forearm_angles[0,0] - np.pi/2
-                linkage = lower_actuator - upper_actuator
-                linkage_dir = linkage/np.linalg.norm(linkage)
-                forearm_dir = forearm/np.linalg.norm(forearm)
-                alpha = np.arccos(linkage_dir.dot(forearm_dir)) - np.pi/2
-                m_p = -(x_l * l * np.cos(theta))/(x_p * np.cos(alpha))
-                P = np.array([np.sin(theta + alpha), np.cos(theta + alpha)]) * m_p
-                F = -(P+L)
-                # elevator = elevator_vecs[0,0]
-                # elevator = elevator/np.linalg.norm(elevator)
-                # elevator_torque = x_e * (- F[1]*elevator[0] + F[0]*elevator[1])
-                # w = -m_p
-
-                # print(np.linalg.norm(linkage))
-                self.point_results = {
-                    'ok' : True,
-                    'elbow_pos' : elbows[0,0],
-                    'goal_pos' : goals[0,0],
-                    'lower_actuator' : lower_actuator,
-                    'upper_actuator' : upper_actuator,
-                    'P': P,
-                    'L': L,
-                    'F': F,
-                    'load': loads[0,0],
-                }
+            self.packagePoint(self.geometry)
+
+    def solveGridGeometry(self, params, cancel=None):
+        '''Solves the retained geometry fields for the full grid of goals
+
+        All of the scratch work happens in the shared workspace for the grid,
+        so the only allocations are the retained fields themselves. With a
+        memory budget, the workspace only ever holds a band of the grid.'''
+        shape = (self.width, self.height)
+        if self.memory_budget is not None:
+            return self.solveBandedGeometry(params, cancel)
+        workspace = getWorkspace(self.width, self.height, self.dtype)
+        unit_x, unit_y, unit_norm = workspace.unitGrid()
+        step = self.dtype.type(self.scaling_factor)
+        goals_x = np.multiply(unit_x, step, out=workspace.get('goals_x', shape))
+        goals_y = np.multiply(unit_y, step, out=workspace.get('goals_y', shape))
+        dists = np.multiply(unit_norm, step, out=workspace.get('dists', shape))
+        geometry = {
+            'actuator_den': np.empty(shape, self.dtype),
+            'elevator_den': np.empty(shape, self.dtype),
+            'partial_ok': np.empty(shape, bool),
+        }
+        # The intermediates aren't needed outside of point mode
+        rows = cancel_rows if cancel is not None else self.width
+        for start in range(0, self.width, rows):
+            if cancel is not None and cancel():
+                raise RVJobCancelled()
+            band = slice(start, start + rows)
+            out = {k: v[band] for k, v in geometry.items()}
+            if self.prune:
+                cells = annulusCells(dists[band], params['elevator_length'],
+                                     params['forearm_length'], workspace)
+                compact = solveCells(cells, goals_x[band], goals_y[band], dists[band],
+                                     workspace, **params)
+                scatterCells(cells, compact, out)
             else:
-                self.point_results = {'ok': False}
+                solveGeometry(goals_x[band], goals_y[band], dists=dists[band],
+                              workspace=workspace, out=out, **params)
+        return geometry
 
-        else:
+    def solveBandedGeometry(self, params, cancel=None):
+        '''solveGridGeometry, in bands which fit the memory budget'''
+        rows = bandRows(self.height, self.dtype, self.memory_budget)
+        if cancel is not None:
+            rows = min(rows, cancel_rows)
+        geometry = {
+            'actuator_den': np.empty((self.width, self.height), self.dtype),
+            'elevator_den': np.empty((self.width, self.height), self.dtype),
+            'partial_ok': np.empty((self.width, self.height), bool),
+        }
+        workspace = getWorkspace(rows, self.height, self.dtype)
+        for start in range(0, self.width, rows):
+            if cancel is not None and cancel():
+                raise RVJobCancelled()
+            stop = min(start + rows, self.width)
+            solveBand(params, self.resolution, start, stop, self.dtype, self.prune,
+                      workspace, {k: v[start:stop] for k, v in geometry.items()})
+        return geometry
+
+    def solveRegionGeometry(self, params, cache=None, cancel=None):
+        '''Solves the retained geometry fields of a viewport region
+
+        The region is stitched together from tiles, each of which is looked
+        up in (and stored to) the cache by its own key, so panning back over
+        a region only solves the tiles which have since been dropped.'''
+        step, tile_x, tile_y, tiles_x, tiles_y = self.region
+        geometry = {
+            'actuator_den': np.empty((self.width, self.height), self.dtype),
+            'elevator_den': np.empty((self.width, self.height), self.dtype),
+            'partial_ok': np.empty((self.width, self.height), bool),
+        }
+        self.solved_cells = 0
+        for tx in range(tiles_x):
+            for ty in range(tiles_y):
+                if cancel is not None and cancel():
+                    raise RVJobCancelled()
+                domain = ('tile', step, tile_x + tx, tile_y + ty, tile_cells, self.dtype.name)
+                key = geometryKey(params, domain)
+                tile = cache.get(key) if cache is not None else None
+                if tile is None:
+                    tile = solveTile(params, step, tile_x + tx, tile_y + ty, self.dtype)
+                    tile['key'] = key
+                    self.solved_cells += tile_cells**2
+                    if cache is not None:
+                        cache.put(key, tile)
+                cells = (slice(tx*tile_cells, (tx + 1)*tile_cells),
+                         slice(ty*tile_cells, (ty + 1)*tile_cells))
+                for k in geometry_fields:
+                    geometry[k][cells] = tile[k]
+        return geometry
+
+    def solveAdaptiveGeometry(self, params, cancel=None):
+        '''Solves the geometry coarse-to-fine, refining only along boundaries
+
+        A lattice of every adaptive'th cell is solved first. Each block of
+        cells between lattice points whose corners all agree on partial_ok
+        and reachable is taken to be uniform, and is not solved: reachable
+        blocks are interpolated bilinearly from their corners, and the rest
+        filled in from the nearest corner. Blocks which straddle a boundary
+        are split in four, and so on down to single cells, so only a
+        fraction of the cells are solved.
+
+        The result is approximate (see RVIK.approximate). Boundaries which
+        cross a block are traced down to the cell, but features which fall
+        between the corners of a coarse block are missed entirely, and
+        interpolated loads can be some way off where they vary sharply.'''
+        step = self.adaptive
+        workspace = getWorkspace(self.width, self.height, self.dtype)
+        # Solve over a grid padded out to a whole number of coarse blocks;
+        # the final lattice row and column then lie outside of the grid
+        blocks_x = -(-self.width // step)
+        blocks_y = -(-self.height // step)
+        shape = (blocks_x*step + 1, blocks_y*step + 1)
+        geometry = {
+            'actuator_den': np.full(shape, np.nan, self.dtype),
+            'elevator_den': np.full(shape, np.nan, self.dtype),
+            'partial_ok': np.zeros(shape, bool),
+        }
+        reachable = np.zeros(shape, bool)
+        solved = np.zeros(shape, bool)
+
+        def solveCellsAt(x, y):
+            goals_x = (x * self.scaling_factor).astype(self.dtype)
+            goals_y = ((self.height/2 - y) * self.scaling_factor).astype(self.dtype)
+            fields = solveGeometry(goals_x, goals_y, workspace=workspace, **params)
+            for k in geometry_fields:
+                geometry[k][x, y] = fields[k]
+            reachable[x, y] = solveLoads(fields, **params)['reachable']
+            solved[x, y] = True
+
+        x, y = np.meshgrid(np.arange(0, shape[0], step), np.arange(0, shape[1], step),
+                           indexing='ij')
+        solveCellsAt(x.ravel(), y.ravel())
+        # Fill everything from the nearest coarse lattice point to start with
+        near_x = (np.arange(shape[0]) + step//2) // step
+        near_y = (np.arange(shape[1]) + step//2) // step
+        for k in geometry_fields:
+            corners = geometry[k][::step, ::step]
+            geometry[k][...] = corners.take(np.minimum(near_x, blocks_x), 0).take(np.minimum(near_y, blocks_y), 1)
+        # Blocks (by their top left corner, in units of the step) to examine
+        active = np.ones((blocks_x, blocks_y), bool)
+        while step > 1:
+            if cancel is not None and cancel():
+                raise RVJobCancelled()
+            # Blocks are mixed if their corners disagree on either mask
+            mixed = np.zeros_like(active)
+            for field in (geometry['partial_ok'], reachable):
+                corners = field[::step, ::step]
+                first = corners[:-1, :-1]
+                for other in (corners[1:, :-1], corners[:-1, 1:], corners[1:, 1:]):
+                    mixed |= first != other
+            mixed &= active
+            half = step//2
+            uniform = active & ~mixed
+            offsets = np.arange(step)
+            # Fill the rest of each uniform block from its nearest corner. The
+            # whole grid was filled from the coarse lattice to begin with, so
+            # from then on only the (few) blocks being refined need it
+            if step < self.adaptive:
+                bx, by = np.nonzero(uniform)
+                x = (bx[:, np.newaxis]*step + offsets)[:, :, np.newaxis]
+                y = (by[:, np.newaxis]*step + offsets)[:, np.newaxis, :]
+                near_x = (bx[:, np.newaxis]*step + (offsets >= half)*step)[:, :, np.newaxis]
+                near_y = (by[:, np.newaxis]*step + (offsets >= half)*step)[:, np.newaxis, :]
+                for k in geometry_fields:
+                    geometry[k][x, y] = geometry[k][near_x, near_y]
+            # The denominators of reachable blocks are interpolated instead.
+            # Their corners' loads all exceed min_load, so the denominators
+            # lie in a range which interpolation can't leave, and every cell
+            # of the block stays reachable
+            corners = reachable[::step, ::step]
+            bx, by = np.nonzero(uniform & corners[:-1, :-1])
+            x0 = (bx*step)[:, np.newaxis, np.newaxis]
+            y0 = (by*step)[:, np.newaxis, np.newaxis]
+            u = (offsets/step)[:, np.newaxis]
+            v = (offsets/step)[np.newaxis, :]
+            for k in ('actuator_den', 'elevator_den'):
+                field = geometry[k]
+                field[x0 + offsets[:, np.newaxis], y0 + offsets] = (
+                    field[x0, y0]*(1 - u)*(1 - v) + field[x0 + step, y0]*u*(1 - v) +
+                    field[x0, y0 + step]*(1 - u)*v + field[x0 + step, y0 + step]*u*v)
+            # Solve the half-step lattice points on the edges or inside of any
+            # mixed block, which are the corners of the next level's blocks
+            padded = np.zeros((blocks_x + 2, blocks_y + 2), bool)
+            padded[1:-1, 1:-1] = mixed
+            lattice_x = np.arange(2*blocks_x + 1)
+            lattice_y = np.arange(2*blocks_y + 1)
+            lower_x, upper_x = (lattice_x - 1)//2 + 1, lattice_x//2 + 1
+            lower_y, upper_y = (lattice_y - 1)//2 + 1, lattice_y//2 + 1
+            needed = (padded[np.ix_(lower_x, lower_y)] | padded[np.ix_(lower_x, upper_y)] |
+                      padded[np.ix_(upper_x, lower_y)] | padded[np.ix_(upper_x, upper_y)])
+            x, y = np.nonzero(needed & ~solved[::half, ::half])
+            if len(x) > 0:
+                solveCellsAt(x*half, y*half)
+            active = np.repeat(np.repeat(mixed, 2, 0), 2, 1)
+            blocks_x *= 2
+            blocks_y *= 2
+            step = half
+        self.solved_cells = int(np.count_nonzero(solved[:self.width, :self.height]))
+        return {k: v[:self.width, :self.height] for k, v in geometry.items()}
+
+    def __getattr__(self, name):
+        '''Evaluates (and memoizes) result fields as they're asked for
+
+        Only called for attributes which aren't already set; see
+        field_dependencies.'''
+        if name not in field_dependencies:
+            raise AttributeError(name)
+        if self.__dict__.get('geometry') is None:
+            raise Exception('Cannot evaluate {0} for a solution stripped to the {1} profile'.format(name, self.profile))
+        value = self.evaluateField(name)
+        self.__dict__[name] = value
+        self.field_order[name] = True
+        self.trimFields(name)
+        return value
+
+    def evaluateField(self, name):
+        '''Computes a single result field from its dependencies'''
+        if name == 'partial_ok':
+            return self.geometry['partial_ok']
+        elif name == 'actuator_loads':
+            torque = np.asarray(abs(self.params['actuator_torque']), self.geometry['actuator_den'].dtype)
+            return np.divide(torque, self.geometry['actuator_den'])
+        elif name == 'elevator_loads':
+            torque = np.asarray(abs(self.params['elevator_torque']), self.geometry['elevator_den'].dtype)
+            return np.divide(torque, self.geometry['elevator_den'])
+        elif name == 'loads':
+            return np.minimum(self.actuator_loads, self.elevator_loads)
+        elif name == 'reachable':
+            reachable = np.greater(self.loads, self.params['min_load'])
+            reachable &= self.partial_ok
+            return reachable
+        elif name == 'sample_field':
+            return np.where(self.reachable, self.loads, 0)
+        elif name == 'contours':
             # Contour-map the reachable region
-            im2, contours, hierarchy = cv2.findContours(np.array(-ok, np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            if len(contours) > 0:
-                self.contours = []
-                for contour in contours:
-                    self.contours.append((contour - [self.height/2, 0]) * step)
-            else:
-                self.contours = None
+            return findContours(self.reachable, self.origin, self.scaling_factor)
+        elif name == 'valid_points':
+            return np.sum(self.reachable)
+        elif name == 'valid_indices':
+            return np.argwhere(self.reachable)
+
+    def invalidate(self, *names):
+        '''Drops the fields which depend (directly or not) on any of names'''
+        stale = set(names)
+        # Dependencies are always declared before the fields using them
+        for field, dependencies in field_dependencies.items():
+            if stale.intersection(dependencies):
+                stale.add(field)
+                self.__dict__.pop(field, None)
+                self.field_order.pop(field, None)
+
+    def trimFields(self, keep=None):
+        '''Drops the oldest droppable fields until they fit the field budget
+
+        The field named by keep is never dropped. Nothing is dropped from a
+        stripped solution, as it has no geometry to recompute from.'''
+        if self.field_budget is None or self.geometry is None:
+            return
+        held = [name for name in self.field_order
+                if name in droppable_fields and self.__dict__.get(name) is not None]
+        total = sum(self.__dict__[name].nbytes for name in held)
+        for name in held:
+            if total <= self.field_budget:
+                break
+            if name != keep:
+                total -= self.__dict__.pop(name).nbytes
+                del self.field_order[name]
 
-            self.valid_points = np.sum(ok)
-            self.valid_indices = np.dstack(np.where(ok)).reshape(self.valid_points, 2)
+    def packagePoint(self, fields):
+        '''In point mode we just package up the point's results
+
+        fields are the point's (full) geometry fields'''
+        upper_actuator_length = self.config['upper_actuator_length'].value
+        lower_actuator_length = self.config['lower_actuator_length'].value
+        forearm_length = self.config['forearm_length'].value
+        elbow = np.array([fields['elbows_x'][0,0], fields['elbows_y'][0,0]], dtype=float)
+        # Calculate the actuator vector
+        a = fields['actuator_angles'][0,0]
+        lower_actuator = lower_actuator_length * np.array([np.sin(a), np.cos(a)])
+        forearm = np.array([fields['forearm_x'][0,0], fields['forearm_y'][0,0]], dtype=float)
+        upper_actuator = elbow - upper_actuator_length * forearm / np.linalg.norm(forearm)
+        if self.reachable[0,0]:
+            # say load is 20N
+            l = self.loads[0,0]
+            L = np.array([0, -l])
+            # Divide by 1000 to convert units from mm to M
+            x_p = upper_actuator_length/1000
+            x_l = forearm_length/1000
+            theta = fields['forearm_angles'][0,0] - np.pi/2
+            linkage = lower_actuator - upper_actuator
+            linkage_dir = linkage/np.linalg.norm(linkage)
+            forearm_dir = forearm/np.linalg.norm(forearm)
+            alpha = np.arccos(linkage_dir.dot(forearm_dir)) - np.pi/2
+            m_p = -(x_l * l * np.cos(theta))/(x_p * np.cos(alpha))
+            P = np.array([np.sin(theta + alpha), np.cos(theta + alpha)]) * m_p
+            F = -(P+L)
+            self.point_results = {
+                'ok' : True,
+                'elbow_pos' : elbow,
+                'goal_pos' : np.array(self.point, dtype=float),
+                'lower_actuator' : lower_actuator,
+                'upper_actuator' : upper_actuator,
+                'P': P,
+                'L': L,
+                'F': F,
+                'load': self.loads[0,0],
+            }
+        else:
+            self.point_results = {'ok': False}
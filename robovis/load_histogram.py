@@ -6,6 +6,43 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
+below_color = QColor(100, 100, 100)
+above_color = QColor(200, 180, 100)
+
+class RVLoadSummary(object):
+    '''Load distribution of a solution, built once and queried cheaply
+
+    Holds the sorted loads of the cells which can be reached at any minimum
+    load, and the histogram of them. The sorted loads act as an exact
+    cumulative distribution, so counts above a load cost a binary search.'''
+    def __init__(self, ik):
+        loads = ik.loads[ik.partial_ok]
+        loads = loads[np.isfinite(loads) & (loads != 0)]
+        self.sorted_loads = np.sort(loads)
+        if len(loads) > 0:
+            self.hist, self.edges = np.histogram(self.sorted_loads, bins='auto')
+        else:
+            self.hist, self.edges = np.zeros(1, dtype=int), np.array([0.0, 1.0])
+        self.centers = (self.edges[:-1] + self.edges[1:]) / 2
+        # Estimated loads (see RVIK.approximate) give estimated counts
+        self.approximate = ik.approximate
+
+    def countAbove(self, load):
+        '''Number of cells reachable with the given minimum load'''
+        return len(self.sorted_loads) - np.searchsorted(self.sorted_loads, load, side='right')
+
+    def binsBelow(self, load):
+        '''Number of (leading) bins centered below the given load'''
+        return int(np.searchsorted(self.centers, load, side='left'))
+
+def summaryKey(ik):
+    '''Identifies what a solution's load summary depends on
+
+    The minimum load isn't part of it, so changing it reuses the summary.'''
+    if ik.geometry is None:
+        return id(ik)
+    return (ik.geometry['key'], ik.params['actuator_torque'], ik.params['elevator_torque'])
+
 class RVLoadHistogram(QGraphicsView):
     '''A histogram for the maximum load across the reachable area'''
     def __init__(self, ik):
@@ -29,9 +66,20 @@ class RVLoadHistogram(QGraphicsView):
         'mouseMove' : []
         }
 
+        # Retained bar items; see updateBars
         self.lines = []
-        self.hist = []
-        self.edges = []
+        self.summary = None
+        self.summary_key = None
+        # Number of bars currently colored as below the minimum load
+        self.split = 0
+        self.setpoint = self.scene.addLine(0, 0, 0, 0, QPen(QColor(150, 150, 255), 2))
+        self.setpoint.setZValue(1)
+        font = QFont()
+        font.setPointSize(8)
+        self.label = self.scene.addSimpleText('', font)
+        self.label.setBrush(QBrush(QColor(80, 80, 80)))
+        self.label.setFlag(QGraphicsItem.ItemIgnoresTransformations)
+        self.label.setPos(4, height - 2)
         self.config = ik.config
         self.update(ik)
 
@@ -41,43 +89,46 @@ class RVLoadHistogram(QGraphicsView):
         if ik is not None:
             self.ik = ik
             self.min_load = self.config['min_load'].value
-
-        for line in self.lines:
-            self.scene.removeItem(line)
-        self.lines = []
-
-        width = self.width()
-        height = self.height()
-
-        loads = np.ma.masked_invalid(self.ik.loads*self.ik.partial_ok)
-        loads = np.ma.masked_where(loads == 0, loads).compressed()
-        self.hist, self.edges = np.histogram(loads, bins='auto')
-
-        buckets = len(self.hist)
-        self.screen_step = width/np.max(self.edges)
-        max_count = np.max(self.hist)
-
-        # Display histogram
-        for i in range(buckets):
-            x = self.edges[i] * self.screen_step
-            w = max(1, (self.edges[i+1] - self.edges[i]) * self.screen_step)
-            l = (self.edges[i] + self.edges[i + 1]) / 2
-            count = self.hist[i]
-            if l < self.min_load:
-                color = QColor(100,100,100)
-            else:
-                color = QColor(200, 180, 100)
-            # print(count)
-            line = self.scene.addLine(x, 5, x, 5 + (height-5) * count/max_count, QPen(color, w))
-            self.lines.append(line)
+            key = summaryKey(ik)
+            if key != self.summary_key:
+                self.summary = RVLoadSummary(ik)
+                self.summary_key = key
+                self.updateBars()
         # Setpoint shows the configuration's minimum load
         setpoint = self.config['min_load'].value * self.screen_step
-        line = self.scene.addLine(setpoint, 0, setpoint, height, QPen(QColor(150, 150, 255), 2))
-        self.lines.append(line)
+        self.setpoint.setLine(setpoint, 0, setpoint, self.height())
+        self.setMinimumLoad(self.min_load)
+
+    def updateBars(self):
+        '''Lays out the bar items for a new summary, reusing existing items'''
+        hist = self.summary.hist
+        edges = self.summary.edges
+        height = self.height()
+        self.screen_step = self.width()/np.max(edges)
+        max_count = max(1, np.max(hist))
+        while len(self.lines) < len(hist):
+            self.lines.append(self.scene.addLine(0, 0, 0, 0))
+        while len(self.lines) > len(hist):
+            self.scene.removeItem(self.lines.pop())
+        self.split = self.summary.binsBelow(self.min_load)
+        for i, line in enumerate(self.lines):
+            x = edges[i] * self.screen_step
+            w = max(1, (edges[i+1] - edges[i]) * self.screen_step)
+            line.setLine(x, 5, x, 5 + (height-5) * hist[i]/max_count)
+            line.setPen(QPen(below_color if i < self.split else above_color, w))
 
     def setMinimumLoad(self, val):
+        '''Previews a minimum load; only the bars it crosses are recolored'''
         self.min_load = val
-        self.update()
+        split = self.summary.binsBelow(val)
+        color = below_color if split > self.split else above_color
+        for line in self.lines[min(split, self.split):max(split, self.split)]:
+            pen = line.pen()
+            pen.setColor(color)
+            line.setPen(pen)
+        self.split = split
+        self.label.setText('{0}{1} reachable cells above {2:.1f}N'.format(
+            '~' if self.summary.approximate else '', self.summary.countAbove(val), val))
 
     def subscribe(self, event, function):
         self.subscribers[event].append(function)
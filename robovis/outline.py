@@ -1,4 +1,7 @@
+import math
+
 import numpy as np
+import cv2
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -6,10 +9,35 @@ from PyQt5.QtGui import *
 
 from robovis import RVIK
 
+def contourPolygon(contour, tolerance=None):
+    '''Converts an RVIK contour to a QPolygonF, with no per-point Python calls
+
+    The points are written straight into the polygon's storage. With a
+    tolerance (in scene units), the contour is first decimated so that it
+    strays no further than that from the original (see cv2.approxPolyDP).'''
+    if tolerance:
+        contour = cv2.approxPolyDP(contour.astype(np.float32), tolerance, True)
+    points = contour.reshape(-1, 2)
+    if len(points) == 0:
+        return QPolygonF()
+    poly = QPolygonF(len(points))
+    data = poly.data()
+    # QPointF is a pair of qreals (doubles)
+    data.setsize(points.size * np.dtype(np.float64).itemsize)
+    coords = np.frombuffer(data, dtype=np.float64).reshape(-1, 2)
+    coords[:, 0] = points[:, 1]
+    coords[:, 1] = -points[:, 0]
+    return poly
+
 class RVOutline(object):
-    def __init__(self, scene, ik = None, color=Qt.white, thickness=1, style=Qt.SolidLine):
+    def __init__(self, scene, ik = None, color=Qt.white, thickness=1, style=Qt.SolidLine, tolerance=None):
         self.scene = scene
         self.contours = None
+        # Decimation tolerance in scene units (see setTolerance), and the
+        # polygons built at it
+        self.tolerance = None
+        self.setTolerance(tolerance)
+        self.polygons = None
         self.color = color
         self.thickness = thickness
         self.style = style
@@ -46,19 +74,36 @@ class RVOutline(object):
             item.setPen(pen)
         self.color = color
 
+    def setTolerance(self, tolerance):
+        '''Sets how far (in scene units) the drawn outline may stray from the
+        contours, so the vertex count follows the on-screen detail
+
+        Tolerances are rounded to a power of two, so the outline is only
+        rebuilt once the zoom has changed appreciably. None draws every
+        vertex.'''
+        if tolerance:
+            tolerance = 2.0**round(math.log(tolerance, 2))
+        else:
+            tolerance = None
+        if tolerance != self.tolerance:
+            self.tolerance = tolerance
+            self.polygons = None
+            if self.contours is not None and not self.hidden:
+                self.updateGraphics()
+
     def update(self, ik):
         self.ik = ik
         self.contours = ik.contours
+        self.polygons = None
         self.updateGraphics()
 
     def updateGraphics(self):
         if self.contours is not None:
+            if self.polygons is None:
+                self.polygons = [contourPolygon(contour, self.tolerance)
+                                 for contour in self.contours]
             c = 0
-            for contour in self.contours:
-                poly = QPolygonF()
-                # Convert contour coordinates to polygon
-                for i in range(contour.shape[0]):
-                    poly << QPointF(contour[i, 0, 1], -contour[i, 0, 0])
+            for poly in self.polygons:
                 # Add a new polygon if we've run out
                 if c == len(self.graphicsItems):
                     self.addPolygon()
@@ -78,3 +123,133 @@ class RVOutline(object):
     def show(self):
         self.hidden = False
         self.updateGraphics()
+
+
+# Largest image side the outline layer will render, in pixels
+max_layer_size = 4096
+
+class RVOutlineLayer(object):
+    '''A single cached image which a set of RVRasterOutlines are drawn into
+
+    However many outlines share the layer, the scene only has to composite
+    one pixmap. The image is only redrawn once something invalidates it (an
+    outline's result, color or visibility changing, or the view zooming or
+    panning out of the rendered area), and invalidations are coalesced
+    into a single redraw.'''
+    def __init__(self, scene):
+        self.scene = scene
+        self.graphicsItem = scene.addPixmap(QPixmap())
+        self.outlines = []
+        # Scene area to render, and the size of a screen pixel in it
+        self.visible_rect = None
+        self.pixel_size = 1.0
+        # Scene area covered by the current image
+        self.rect = None
+        self.dirty = False
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.redraw)
+
+    def add(self, outline):
+        self.outlines.append(outline)
+        self.invalidate()
+
+    def setViewport(self, rect, pixel_size):
+        '''Matches the layer to the view; see RVView.visibleRect/pixelSize'''
+        x0, y0, x1, y1 = rect
+        rect = QRectF(QPointF(x0, y0), QPointF(x1, y1))
+        self.visible_rect = rect
+        if pixel_size != self.pixel_size:
+            self.pixel_size = pixel_size
+            self.invalidate()
+        elif self.rect is not None and not self.rect.contains(rect):
+            self.invalidate()
+
+    def invalidate(self):
+        if not self.dirty:
+            self.dirty = True
+            self.timer.start(0)
+
+    def redraw(self):
+        self.dirty = False
+        drawn = [outline for outline in self.outlines
+                 if not outline.hidden and outline.polygons]
+        bounds = QRectF()
+        for outline in drawn:
+            for poly in outline.polygons:
+                bounds = bounds.united(poly.boundingRect())
+        if len(drawn) > 0:
+            pad = max(outline.thickness for outline in drawn)
+            bounds.adjust(-pad, -pad, pad, pad)
+        if self.visible_rect is not None:
+            # Render a margin around the view, so panning doesn't
+            # immediately run off the edge
+            margin_x = self.visible_rect.width() / 2
+            margin_y = self.visible_rect.height() / 2
+            bounds = bounds.intersected(self.visible_rect.adjusted(-margin_x, -margin_y, margin_x, margin_y))
+        if bounds.isEmpty():
+            self.rect = None
+            self.graphicsItem.hide()
+            return
+        pixel_size = max(self.pixel_size, max(bounds.width(), bounds.height()) / max_layer_size)
+        image = QImage(int(math.ceil(bounds.width() / pixel_size)),
+                       int(math.ceil(bounds.height() / pixel_size)),
+                       QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.scale(1 / pixel_size, 1 / pixel_size)
+        painter.translate(-bounds.left(), -bounds.top())
+        for outline in drawn:
+            painter.setPen(outline.pen())
+            for poly in outline.polygons:
+                painter.drawPolygon(poly)
+        painter.end()
+        self.rect = bounds
+        self.graphicsItem.setPixmap(QPixmap.fromImage(image))
+        self.graphicsItem.setTransform(QTransform.fromScale(pixel_size, pixel_size))
+        self.graphicsItem.setPos(bounds.topLeft())
+        self.graphicsItem.show()
+
+class RVRasterOutline(RVOutline):
+    '''An RVOutline drawn into a shared RVOutlineLayer, rather than having
+    scene items of its own'''
+    def __init__(self, layer, ik = None, color=Qt.white, thickness=1, style=Qt.SolidLine, tolerance=None):
+        self.layer = layer
+        self.scene = layer.scene
+        self.contours = None
+        self.color = QColor(color)
+        self.thickness = thickness
+        self.style = style
+        self.hidden = False
+        self.tolerance = None
+        self.polygons = None
+        self.setTolerance(tolerance)
+        self.solver = None
+        layer.add(self)
+        if ik:
+            self.ik = ik
+            self.update(self.ik)
+        else:
+            self.ik = None
+
+    def pen(self):
+        return QPen(QBrush(self.color), self.thickness, self.style)
+
+    def setColor(self, color):
+        if color != self.color:
+            self.color = color
+            self.layer.invalidate()
+
+    def updateGraphics(self):
+        if self.polygons is None:
+            if self.contours is not None:
+                self.polygons = [contourPolygon(contour, self.tolerance)
+                                 for contour in self.contours]
+            else:
+                self.polygons = []
+        self.layer.invalidate()
+
+    def hide(self):
+        self.hidden = True
+        self.layer.invalidate()
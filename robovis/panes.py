@@ -5,6 +5,7 @@ from PyQt5.QtGui import *
 import numpy as np
 
 from robovis import *
+from robovis.ik import sampleLoads
 
 class RVParameterBox(QGroupBox):
     def __init__(self, config, parameter, format_str='{0:.2f}', log=False, log_scaling=1):
@@ -236,14 +237,7 @@ class RVSelectionPane(QWidget):
             data = [0]*7
             self.chart.setData(data)
         else:
-            data = []
-            for outline in self.outlines:
-                if outline.ik != None:
-                    data.append(outline.ik.sampleLoad(picked.goal))
-                else:
-                    data.append(0)
-            if self.main_outline.ik != None:
-                data.insert(3, self.main_outline.ik.sampleLoad(picked.goal))
-            else:
-                data.insert(3, 0)
+            iks = [outline.ik for outline in self.outlines]
+            iks.insert(3, self.main_outline.ik)
+            data = list(sampleLoads(iks, [picked.goal])[:, 0])
             self.chart.setData(data)
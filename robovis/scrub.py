@@ -0,0 +1,157 @@
+'''Dense cache of solutions along the hovered parameter, for slider scrubbing'''
+from collections import OrderedDict
+import math
+
+from robovis import RVConfig
+from robovis.ik import RVSolver, blendIK, load_params
+from robovis.workerpool import priority_scrub
+
+# Spacing of the cached values, as a ratio between neighbours
+scrub_increment = 1.005
+# Values cached to either side of the current value
+scrub_steps = 10
+# Values within this fraction of a step of a cached value are served as is
+scrub_snap = 0.1
+
+class RVScrubCache(object):
+    '''Solutions at a dense, geometric lattice of values of one parameter
+
+    Every other parameter is held at a base configuration. The lattice
+    around the current value is filled in the background by the pool, at
+    the lowest priority, and follows the value as it's scrubbed. Solutions
+    are evicted least recently used first once there are more than size.
+
+    Only length parameters are cached; load parameters are already solved
+    locally by rescaling the current geometry.'''
+    def __init__(self, pool, resolution=100, size=24, fillers=2):
+        self.pool = pool
+        self.resolution = resolution
+        self.size = size
+        self.param = None
+        self.base = None
+        self.anchor = None
+        # The configuration being scrubbed, and its lattice index
+        self.config = None
+        self.center = None
+        # Lattice index -> solution, oldest use first
+        self.solutions = OrderedDict()
+        # Bumped whenever the lattice is reset, so stale fills are dropped
+        self.generation = 0
+        self.fillers = []
+        for i in range(fillers):
+            solver = RVSolver(pool, resolution=resolution)
+            solver.subscribe('ready', lambda ik, solver=solver: self.receive(solver, ik))
+            self.fillers.append(solver)
+
+    def setParam(self, param):
+        '''Switches the cache over to a new parameter, dropping everything'''
+        if param in load_params:
+            param = None
+        if param != self.param:
+            self.param = param
+            self.reset()
+
+    def reset(self, config=None):
+        self.generation += 1
+        self.solutions.clear()
+        for solver in self.fillers:
+            self.pool.cancel(solver)
+            solver.data = {}
+        if config is None or self.param is None:
+            self.base = None
+            self.anchor = None
+        else:
+            self.base = self.baseOf(config)
+            self.anchor = config[self.param].value
+
+    def baseOf(self, config):
+        '''Everything about config which the lattice holds fixed'''
+        raw = config.getRaw()
+        # The linkage length follows the elevator length and rod ratio
+        for key in (self.param, 'linkage_length'):
+            raw.pop(key)
+        return raw
+
+    def index(self, value):
+        '''Fractional lattice index of a value of the parameter'''
+        if value <= 0 or self.anchor <= 0:
+            return None
+        return math.log(value / self.anchor) / math.log(scrub_increment)
+
+    def valueAt(self, k):
+        return self.anchor * scrub_increment**k
+
+    def lookup(self, config):
+        '''Finds a cached solution for config, as (ik, exact)
+
+        A value close to a cached one is served as is (exact). A value
+        between two cached neighbours gets a blend of them (see blendIK),
+        which should be followed by a proper solve. Otherwise returns
+        (None, False).'''
+        if self.param is None or self.base is None or self.baseOf(config) != self.base:
+            return (None, False)
+        x = self.index(config[self.param].value)
+        if x is None:
+            return (None, False)
+        k = int(round(x))
+        if abs(x - k) <= scrub_snap and k in self.solutions:
+            self.solutions.move_to_end(k)
+            return (self.solutions[k], True)
+        k0 = int(math.floor(x))
+        if k0 in self.solutions and k0 + 1 in self.solutions:
+            self.solutions.move_to_end(k0)
+            self.solutions.move_to_end(k0 + 1)
+            return (blendIK(self.solutions[k0], self.solutions[k0 + 1], x - k0, config), False)
+        return (None, False)
+
+    def fill(self, config):
+        '''Queues solves for the missing values around config's
+
+        The lattice is reset if anything other than the parameter changed.'''
+        if self.param is None:
+            return
+        if self.base is None or self.baseOf(config) != self.base:
+            self.reset(config)
+        x = self.index(config[self.param].value)
+        if x is None:
+            return
+        self.center = int(round(x))
+        self.config = RVConfig(config)
+        for solver in self.fillers:
+            if 'k' not in solver.data:
+                self.fillNext(solver)
+
+    def fillNext(self, solver):
+        '''Starts the filler on the nearest missing value, if there is one'''
+        solver.data = {}
+        if self.config is None or self.base is None:
+            return
+        busy = set(other.data.get('k') for other in self.fillers)
+        for offset in range(scrub_steps + 1):
+            for k in (self.center - offset, self.center + offset):
+                if k in self.solutions or k in busy:
+                    continue
+                value = self.valueAt(k)
+                param = self.config[self.param]
+                if value < param.min or value > param.max:
+                    continue
+                config = RVConfig(self.config)
+                config[self.param].value = value
+                if solver.hasSolution(config):
+                    # Solved before the last reset; solveAsync wouldn't
+                    # deliver it again
+                    self.store(k, solver.ik)
+                    continue
+                solver.data = {'k': k, 'generation': self.generation}
+                solver.solveAsync(config, priority_scrub)
+                return
+
+    def store(self, k, ik):
+        self.solutions[k] = ik
+        while len(self.solutions) > self.size:
+            self.solutions.popitem(last=False)
+
+    def receive(self, solver, ik):
+        if solver.data.get('generation') == self.generation:
+            self.store(solver.data['k'], ik)
+        self.fillNext(solver)
@@ -0,0 +1,318 @@
+'''Headless design-space sweeps over many arm configurations
+
+Sweeps run RVIK outside of the GUI: configurations are fanned out across a
+process pool, and a summary of each solution is appended to a YAML stream as
+soon as it completes. Each record is closed with an explicit document end
+marker, so a sweep interrupted part-way through can be resumed from the same
+output file without re-solving anything that was already written out.
+
+Run from the root directory with `python -m robovis.sweep spec.yml out.yml`
+'''
+import argparse
+import hashlib
+import itertools
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import yaml
+
+from robovis import RVConfig
+from robovis.config import key_digits
+from robovis.ik import solveBatch, geometry_cache, setGeometryCacheSize, load_params
+
+def expandRanges(ranges, base=None):
+    '''Expands a {param: values} dict into a list of raw configurations
+
+    Values may be a list of explicit values, or a (start, stop, num) tuple
+    which is expanded with np.linspace. Parameters not mentioned are taken
+    from the base raw configuration (or the default RVConfig).'''
+    if base is None:
+        base = RVConfig().getRaw()
+    # Load parameters are iterated innermost, so neighbouring jobs share the
+    # same geometry
+    params = sorted(ranges.keys(), key=lambda p: (p in load_params, p))
+    value_lists = []
+    for p in params:
+        vals = ranges[p]
+        if isinstance(vals, tuple):
+            vals = np.linspace(*vals)
+        value_lists.append([float(v) for v in vals])
+    raws = []
+    for combo in itertools.product(*value_lists):
+        raw = dict(base)
+        # Parameters must be applied after the base values, as setting
+        # e.g. the rod ratio also updates the linkage length
+        for p, val in zip(params, combo):
+            raw.pop(p, None)
+            raw[p] = val
+        # A linkage length in the raw config takes precedence (see
+        # resolveConfig), so the base's is dropped when it should follow
+        # a swept ratio or elevator length
+        if 'linkage_length' not in ranges and ('rod_ratio' in ranges or 'elevator_length' in ranges):
+            raw.pop('linkage_length', None)
+        raws.append(raw)
+    return raws
+
+def resolveConfig(raw):
+    '''Returns the configuration for a (possibly partial) raw config
+
+    An explicit linkage length takes precedence over the rod ratio, which is
+    derived from it; otherwise the linkage follows the ratio and elevator
+    length, whichever order they're applied in.'''
+    config = RVConfig()
+    config.loadRaw(raw)
+    if 'linkage_length' in raw:
+        linkage = float(raw['linkage_length'])
+        config['rod_ratio'].value = linkage / config['elevator_length'].value
+        config['linkage_length'].value = linkage
+    return config
+
+def resolveRaw(raw):
+    '''Returns the fully-resolved raw form of a (possibly partial) raw config'''
+    return {key: float(val) for key, val in resolveConfig(raw).getRaw().items()}
+
+def configKey(config, resolution):
+    '''Stable identifier for a configuration at a resolution (see RVConfig.key)'''
+    text = repr((list(config.key()), resolution)).encode('utf-8')
+    return hashlib.sha1(text).hexdigest()[:16]
+
+def summarize(ik):
+    '''Builds a plain (YAML-friendly) summary of a full-range IK solution'''
+    reachable = ik.reachable.astype(bool)
+    loads = ik.loads[reachable]
+    summary = {
+        'resolution': ik.resolution,
+        'scaling_factor': float(ik.scaling_factor),
+        'total_cells': int(ik.width*ik.height),
+        'reachable_cells': int(ik.valid_points),
+        'reachable_area': float(ik.valid_points * ik.scaling_factor**2),
+    }
+    if loads.size > 0:
+        summary['load'] = {
+            'min': float(np.min(loads)),
+            'max': float(np.max(loads)),
+            'mean': float(np.mean(loads)),
+            'median': float(np.median(loads)),
+        }
+    else:
+        summary['load'] = None
+    # Contours are stored in scene coordinates (mm), as drawn by RVOutline
+    contours = []
+    if ik.contours is not None:
+        for contour in ik.contours:
+            contours.append([[float(pt[0, 1]), float(-pt[0, 0])] for pt in contour])
+    summary['contours'] = contours
+    return summary
+
+def runSweepBatch(jobs, resolution, fields_dir=None):
+    '''Solves a batch of (key, raw config) sweep jobs
+
+    Returns their records, along with the worker's geometry cache stats.'''
+    configs = []
+    for key, raw in jobs:
+        config = resolveConfig(raw)
+        # Records list the raw config, so it had better be what was solved
+        for param, val in raw.items():
+            if round(float(val) - config[param].value, key_digits) != 0:
+                raise Exception('Sweep config {0} resolved {1} to {2}, not {3}'.format(
+                    key, param, config[param].value, val))
+        configs.append(config)
+    records = []
+    # Unreachable cells produce NaNs and infinities along the way
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for (key, raw), ik in zip(jobs, solveBatch(configs, resolution, cache=geometry_cache)):
+            if fields_dir is not None:
+                path = os.path.join(fields_dir, key + '.npz')
+                tmp_path = path + '.tmp.npz'
+                np.savez_compressed(tmp_path,
+                                    loads=ik.loads,
+                                    actuator_loads=ik.actuator_loads,
+                                    elevator_loads=ik.elevator_loads,
+                                    partial_ok=ik.partial_ok,
+                                    reachable=ik.reachable)
+                os.replace(tmp_path, path)
+            records.append({
+                'key': key,
+                'config': raw,
+                'summary': summarize(ik),
+            })
+    return records, (os.getpid(), geometry_cache.stats())
+
+def _runSweepBatch(args):
+    return runSweepBatch(*args)
+
+
+class RVSweep(object):
+    '''A resumable sweep over a set of configurations'''
+    def __init__(self, output, configs=None, ranges=None, base=None,
+                 resolution=100, save_fields=False, processes=None,
+                 batch_size=8, geometry_cache_size=32):
+        self.output = output
+        self.resolution = resolution
+        self.batch_size = batch_size
+        self.geometry_cache_size = geometry_cache_size
+        # Latest geometry cache stats from each worker process
+        self.worker_stats = {}
+        self.processes = processes
+        if save_fields:
+            self.fields_dir = os.path.splitext(output)[0] + '_fields'
+        else:
+            self.fields_dir = None
+        self.subscribers = {
+            'result': []
+        }
+
+        raws = list(configs or [])
+        if ranges:
+            raws += expandRanges(ranges, base)
+        # Resolve and de-duplicate the configurations, keeping their order
+        self.jobs = []
+        seen = set()
+        for raw in raws:
+            config = resolveConfig(raw)
+            key = configKey(config, resolution)
+            if key not in seen:
+                seen.add(key)
+                self.jobs.append((key, resolveRaw(raw)))
+        self.completed = self.recover()
+
+    def recover(self):
+        '''Reads back completed records, discarding any partial trailing write'''
+        completed = set()
+        if not os.path.exists(self.output):
+            return completed
+        with open(self.output, 'r') as file:
+            text = file.read()
+        end = 0
+        marker = '\n...\n'
+        while True:
+            pos = text.find(marker, end)
+            if pos < 0:
+                break
+            chunk = text[end:pos + len(marker)]
+            try:
+                record = yaml.safe_load(chunk)
+            except yaml.YAMLError:
+                break
+            if isinstance(record, dict) and 'key' in record:
+                completed.add(record['key'])
+            end = pos + len(marker)
+        if end < len(text):
+            # Interrupted mid-record; truncate back to the last complete one
+            with open(self.output, 'r+') as file:
+                file.truncate(len(text[:end].encode('utf-8')))
+        return completed
+
+    def pending(self):
+        '''The (key, raw config) pairs which still need solving'''
+        return [(key, raw) for key, raw in self.jobs if key not in self.completed]
+
+    def subscribe(self, event, func):
+        self.subscribers[event].append(func)
+
+    def run(self):
+        '''Solves all pending configurations, streaming results to disk'''
+        pending = self.pending()
+        if len(pending) == 0:
+            return
+        if self.fields_dir is not None:
+            os.makedirs(self.fields_dir, exist_ok=True)
+        # Configs are solved in small batches; these share a single
+        # broadcasted solve, while keeping results streaming out steadily
+        tasks = []
+        for start in range(0, len(pending), self.batch_size):
+            tasks.append((pending[start:start + self.batch_size],
+                          self.resolution, self.fields_dir))
+        pool = Pool(self.processes,
+                    initializer=setGeometryCacheSize,
+                    initargs=(self.geometry_cache_size,))
+        try:
+            with open(self.output, 'a') as file:
+                for records, (pid, stats) in pool.imap_unordered(_runSweepBatch, tasks):
+                    self.worker_stats[pid] = stats
+                    for record in records:
+                        file.write(yaml.safe_dump(record,
+                                                  default_flow_style=None,
+                                                  explicit_start=True,
+                                                  explicit_end=True))
+                        file.flush()
+                        os.fsync(file.fileno())
+                        self.completed.add(record['key'])
+                        for func in self.subscribers['result']:
+                            func(record)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def cacheStats(self):
+        '''Geometry cache hits and misses, totalled across the workers'''
+        hits = sum(stats['hits'] for stats in self.worker_stats.values())
+        misses = sum(stats['misses'] for stats in self.worker_stats.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'workers': len(self.worker_stats),
+        }
+
+
+def loadSpec(path):
+    '''Loads a sweep specification file
+
+    The spec is a YAML mapping with optional keys `base` (a raw config, or a
+    path to a saved config), `ranges` ({param: [values]} or
+    {param: {start, stop, num}}), `configs` (raw configs or paths),
+    `resolution`, `save_fields`, `batch_size` and `geometry_cache_size`.'''
+    def loadRawConfig(item):
+        if isinstance(item, str):
+            with open(item, 'r') as file:
+                item = yaml.load(file.read(), Loader=yaml.Loader)
+        return {key: float(val) for key, val in item.items()}
+
+    with open(path, 'r') as file:
+        spec = yaml.safe_load(file.read())
+    base = spec.get('base')
+    if base is not None:
+        base = resolveRaw(loadRawConfig(base))
+    ranges = {}
+    for param, vals in (spec.get('ranges') or {}).items():
+        if isinstance(vals, dict):
+            vals = (vals['start'], vals['stop'], int(vals['num']))
+        ranges[param] = vals
+    configs = [loadRawConfig(item) for item in (spec.get('configs') or [])]
+    return {
+        'configs': configs,
+        'ranges': ranges,
+        'base': base,
+        'resolution': spec.get('resolution', 100),
+        'save_fields': spec.get('save_fields', False),
+        'batch_size': spec.get('batch_size', 8),
+        'geometry_cache_size': spec.get('geometry_cache_size', 32),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless RoboVis design sweep')
+    parser.add_argument('spec', help='YAML sweep specification')
+    parser.add_argument('output', help='YAML results stream (resumed if it exists)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Worker processes (defaults to all cores)')
+    args = parser.parse_args()
+
+    spec = loadSpec(args.spec)
+    sweep = RVSweep(args.output, processes=args.processes, **spec)
+    total = len(sweep.jobs)
+    done = [total - len(sweep.pending())]
+    print('{0} configurations, {1} already complete'.format(total, done[0]))
+    def progress(record):
+        done[0] += 1
+        print('[{0}/{1}] {2}: {3} reachable cells'.format(
+            done[0], total, record['key'],
+            record['summary']['reachable_cells']))
+    sweep.subscribe('result', progress)
+    sweep.run()
+    stats = sweep.cacheStats()
+    print('Geometry cache: {0} hits, {1} misses across {2} workers'.format(
+        stats['hits'], stats['misses'], stats['workers']))
+
+if __name__ == '__main__':
+    main()
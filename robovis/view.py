@@ -2,6 +2,9 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
+# Zoom factor per notch of the mouse wheel
+zoom_increment = 1.15
+
 class RVView(QGraphicsView):
     def __init__(self, scene):
         QGraphicsView.__init__(self, scene)
@@ -13,12 +16,14 @@ class RVView(QGraphicsView):
         self.setMinimumSize(400, 300)
         self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.scale(1, -1)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.initScene()
         self.subscribers = {
             'mouseEnter' : [],
             'mouseLeave' : [],
             'mouseMove' : [],
             'mousePress' : [],
+            'viewportChanged' : [],
         }
         self.setMouseTracking(True)
 
@@ -44,3 +49,29 @@ class RVView(QGraphicsView):
     def mousePressEvent(self, event):
         for func in self.subscribers['mousePress']:
             func(event)
+
+    def wheelEvent(self, event):
+        factor = zoom_increment ** (event.angleDelta().y() / 120)
+        self.scale(factor, factor)
+        self.viewportChanged()
+
+    def resizeEvent(self, event):
+        QGraphicsView.resizeEvent(self, event)
+        self.viewportChanged()
+
+    def scrollContentsBy(self, dx, dy):
+        QGraphicsView.scrollContentsBy(self, dx, dy)
+        self.viewportChanged()
+
+    def viewportChanged(self):
+        for func in self.subscribers['viewportChanged']:
+            func(self.visibleRect(), self.pixelSize())
+
+    def visibleRect(self):
+        '''The visible part of the scene, as (x0, y0, x1, y1)'''
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
+    def pixelSize(self):
+        '''The size of a screen pixel in scene units'''
+        return 1 / abs(self.transform().m11())
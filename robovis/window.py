@@ -1,6 +1,5 @@
 from collections import deque
 import os
-from time import sleep
 
 import numpy as np
 import yaml
@@ -11,14 +10,37 @@ from PyQt5.QtGui import *
 
 from robovis import *
 from robovis import RVArmVis
+from robovis.ik import load_params, viewportRegion, ikBufferSize
+from robovis.workerpool import priority_main, priority_ghost, priority_perpendicular
+from robovis.scrub import RVScrubCache
 
 offset_increment = 1.08
 start_param = 'elevator_length'
+# Grid resolution of the solvers, and of the main solver's quick previews
+solve_resolution = 100
+preview_resolution = 40
+# Solutions kept along the hovered parameter for scrubbing (see RVScrubCache)
+scrub_size = 24
+# Recent results the pool keeps, to hand out again for identical solves
+result_cache = 16
+# Shared memory buffers for passing solutions back from the pool; enough for
+# every solver (and the caches) to hold onto one, with some left over for
+# jobs in flight
+result_buffers = 64 + scrub_size + result_cache
+# How far outlines may stray from their contours, in screen pixels
+outline_tolerance = 0.5
+# Draw the ghost outlines into one shared image layer, rather than as
+# separate scene items (see RVOutlineLayer)
+raster_ghosts = True
+
+class RVPoolNotifier(QObject):
+    '''Carries job completions from the worker pool's thread to the GUI thread'''
+    completed = pyqtSignal()
+
 
 class RVWindow(QMainWindow):
     def __init__(self):
         QWidget.__init__(self)
-        self._active = True
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
         layout = QHBoxLayout(central_widget)
@@ -38,7 +60,7 @@ class RVWindow(QMainWindow):
         self.view = RVView(self.scene)
 
         # Fill in scene
-        self.ik = RVIK(self.current_config)
+        self.ik = RVIK(self.current_config, resolution=solve_resolution)
         self.createOutlines()
         self.heatmap = RVHeatmap(self.scene, self.ik)
         self.histogram = RVLoadHistogram(self.ik)
@@ -97,11 +119,18 @@ class RVWindow(QMainWindow):
         self.view.subscribe('mouseMove', self.arm_vis.handleMouseMove)
         self.view.subscribe('mouseLeave', lambda e: self.arm_vis.clearGraphics())
         self.view.subscribe('mousePress', self.viewClick)
+        # Viewport changes come in bursts (e.g. scrolling), so are coalesced
+        self.viewport_timer = QTimer(self)
+        self.viewport_timer.setSingleShot(True)
+        self.viewport_timer.setInterval(50)
+        self.viewport_timer.timeout.connect(self.solveViewport)
+        self.view.subscribe('viewportChanged', lambda rect, pixel_size: self.viewport_timer.start())
 
         self.current_param = start_param
+        # Load ghosts waiting on the main solver's geometry, by solver
+        self.deferred_ghosts = {}
         self.createIKPool()
         self.updateGhosts()
-        QTimer.singleShot(0, self.asyncPoll)
 
     def viewClick(self, event):
         if event.button() == Qt.LeftButton:
@@ -181,7 +210,7 @@ class RVWindow(QMainWindow):
             new_val = top.data['val'] * offset_increment
             new_config[p].value = new_val
             solver.data['val'] = new_val
-            solver.solveAsync(new_config)
+            self.solveGhost(solver, new_config, p)
         for i in range(cleared_high):
             bottom = q[0]
             solver = q.pop()
@@ -191,7 +220,7 @@ class RVWindow(QMainWindow):
             new_val = bottom.data['val'] / offset_increment
             new_config[p].value = new_val
             solver.data['val'] = new_val
-            solver.solveAsync(new_config)
+            self.solveGhost(solver, new_config, p)
         # Resolve any changes
         if modified:
             self.latchOutlines()
@@ -217,29 +246,99 @@ class RVWindow(QMainWindow):
         if param not in self.solvers.keys():
             print('Warning: param ', param, ' not currently solved for')
         else:
+            # The newly hovered parameter's ghosts jump the queue
+            for solver in self.solvers[self.current_param]:
+                solver.setPriority(priority_perpendicular)
+            for solver in self.solvers[param]:
+                solver.setPriority(priority_ghost)
             self.current_param = param
+            self.scrub_cache.setParam(param)
+            self.scrub_cache.fill(self.current_config)
             self.latchOutlines()
             self.updateGhosts()
             self.selection_pane.update()
 
     def configModified(self):
         '''Call when the configuration has been modified - regenerates the outline(s)'''
+        key = self.current_config.key()
+        if key == self.config_key:
+            # Nothing actually changed
+            return
+        self.config_key = key
         # self.selected_arm_vis.update()
-        self.solvers['main'][0].solveLocal(self.current_config)
+        main = self.solvers['main'][0]
+        ik, exact = self.scrub_cache.lookup(self.current_config)
+        if ik is None:
+            # A quick preview is shown while the full solution is on its way
+            main.solveProgressive(self.current_config, preview_resolution)
+        else:
+            main.useSolution(ik)
+            if not exact:
+                # Just a blend of the neighbouring solutions
+                main.solveAsync(self.current_config, priority_main)
+        self.scrub_cache.fill(self.current_config)
         self.updateGhosts()
         self.solvePerpendicular()
+        self.solveViewport(True)
+
+    def solveViewport(self, modified=False):
+        '''Solves the heatmap for just the visible part of the scene
+
+        This is solved at a resolution matched to the view's zoom; see
+        viewportRegion. modified signals the configuration has changed.'''
+        self.updateOutlineDetail()
+        solver = self.view_solver
+        max_dist = self.current_config['elevator_length'].value + self.current_config['forearm_length'].value
+        region = viewportRegion(self.view.visibleRect(), self.view.pixelSize(), max_dist)
+        if region is None:
+            # Nothing in view can be reached; fall back to the main solution
+            solver.region = None
+            self.heatmap.update(self.solvers['main'][0].ik)
+        elif region != solver.region or modified:
+            solver.region = region
+            if solver.hasGeometryFor(self.current_config):
+                solver.solveLocal(self.current_config)
+            else:
+                solver.solveAsync(self.current_config, priority_main)
+
+    def updateOutlineDetail(self):
+        '''Matches the outlines' level of detail to the view's zoom'''
+        tolerance = outline_tolerance * self.view.pixelSize()
+        self.main_outline.setTolerance(tolerance)
+        for outline in self.outlines:
+            outline.setTolerance(tolerance)
+        if self.ghost_layer is not None:
+            self.ghost_layer.setViewport(self.view.visibleRect(), self.view.pixelSize())
 
     def createOutlines(self):
         self.outlines = deque()
+        if raster_ghosts:
+            self.ghost_layer = RVOutlineLayer(self.scene)
+        else:
+            self.ghost_layer = None
         for i in range(6):
-            self.outlines.append(RVOutline(self.scene,
-                                           color=Qt.white,
-                                           thickness=2.5,
-                                           style=Qt.DashLine))
+            if raster_ghosts:
+                outline = RVRasterOutline(self.ghost_layer,
+                                          color=Qt.white,
+                                          thickness=2.5,
+                                          style=Qt.DashLine)
+            else:
+                outline = RVOutline(self.scene,
+                                    color=Qt.white,
+                                    thickness=2.5,
+                                    style=Qt.DashLine)
+            self.outlines.append(outline)
 
     def createIKPool(self):
         # 'None' yields automatic sizing (enough to use all available cores)
-        self.ik_pool = RVWorkerPool(None)
+        self.ik_pool = RVWorkerPool(None,
+                                    shared_buffers=result_buffers,
+                                    shared_buffer_size=ikBufferSize(solve_resolution),
+                                    result_cache=result_cache)
+        # Results are delivered on the GUI thread as soon as they complete
+        self.pool_notifier = RVPoolNotifier()
+        self.pool_notifier.completed.connect(self.deliverResults, Qt.QueuedConnection)
+        self.ik_pool.subscribe('completed', self.pool_notifier.completed.emit)
 
         self.solvers = {}
         params = [
@@ -251,20 +350,34 @@ class RVWindow(QMainWindow):
             'elevator_length',
         ]
 
+        # The main/central solver is in a section of its own
+        self.solvers['main'] = [RVSolver(self.ik_pool, resolution=solve_resolution)]
+        self.solvers['main'][0].subscribe('ready', self.ikComplete)
+        # The heatmap follows the viewport, separately from the main solver
+        self.view_solver = RVSolver(self.ik_pool, resolution=solve_resolution)
+        self.view_solver.subscribe('ready', self.heatmap.update)
+
+        self.solvers['main'][0].solveLocal(self.current_config, self.ik.geometry)
+        self.config_key = self.current_config.key()
+
         # Create the full set of solvers across all parameters
         for p in params:
             q = self.solvers[p] = deque()
             # 4 each of higher and lower slots
             for i in range(8):
-                self.solvers[p].append(RVSolver(self.ik_pool))
+                # Ghosts only show an outline, and are sampled for loads
+                self.solvers[p].append(RVSolver(self.ik_pool,
+                                                resolution=solve_resolution,
+                                                profile='loads'))
 
         self.latchOutlines()
         self.solveParamSet(self.current_param)
         self.solvePerpendicular()
 
-        # The main/central solver is in a section of its own
-        self.solvers['main'] = [RVSolver(self.ik_pool)]
-        self.solvers['main'][0].subscribe('ready', self.ikComplete)
+        # Fills in the hovered parameter around its value, as the pool idles
+        self.scrub_cache = RVScrubCache(self.ik_pool, solve_resolution, scrub_size)
+        self.scrub_cache.setParam(self.current_param)
+        self.scrub_cache.fill(self.current_config)
 
     def solvePerpendicular(self):
         '''Starts pre-solving ghosts for the additional parameters'''
@@ -272,9 +385,9 @@ class RVWindow(QMainWindow):
             if p in ('main', self.current_param):
                 continue
             else:
-                self.solveParamSet(p)
+                self.solveParamSet(p, priority_perpendicular)
 
-    def solveParamSet(self, param):
+    def solveParamSet(self, param, priority=priority_ghost):
         '''Begins solving ghost outlines for the given parameter'''
         p = param
         q = self.solvers[p]
@@ -289,11 +402,29 @@ class RVWindow(QMainWindow):
             config_more[p].value = upper_val
             lower_solver = q[3-i]
             upper_solver = q[4+i]
-            lower_solver.solveAsync(config_less)
-            upper_solver.solveAsync(config_more)
+            self.solveGhost(lower_solver, config_less, p, priority)
+            self.solveGhost(upper_solver, config_more, p, priority)
             lower_solver.data['val'] = lower_val
             upper_solver.data['val'] = upper_val
 
+    def solveGhost(self, solver, config, param, priority=priority_ghost):
+        '''Starts solving a ghost configuration, varied along param'''
+        main = self.solvers['main'][0]
+        self.deferred_ghosts.pop(solver, None)
+        if param in load_params:
+            if main.hasGeometryFor(config):
+                # Only the loads differ from the main solution, so its
+                # geometry can be rescaled in place rather than going to the pool
+                solver.solveLocal(config, main.ik.geometry)
+                return
+            if main.solvingGeometryFor(config):
+                # The main solution is just a preview; wait for the geometry
+                # of its full resolution solve instead (see ikComplete)
+                self.ik_pool.cancel(solver)
+                self.deferred_ghosts[solver] = (config, param, priority)
+                return
+        solver.solveAsync(config, priority)
+
     def latchOutlines(self):
         '''Latches outlines from outline pool to solvers for current param'''
         for outline in self.outlines:
@@ -307,21 +438,23 @@ class RVWindow(QMainWindow):
             q[3 - i].setOutline(outline_l)
             q[4 + i].setOutline(outline_r)
 
-    def asyncPoll(self):
-        while self._active:
-            sleep(0.01)
-            self.ik_pool.poll()
-            # See if any solvers have finished, results are automatically
-            # cascaded out
-            for p, set in self.solvers.items():
-                for solver in set:
-                    solver.poll()
-            qApp.processEvents()
+    def deliverResults(self):
+        '''Called on the GUI thread whenever pool jobs have completed'''
+        # Finished solvers' results are automatically cascaded out
+        self.ik_pool.poll()
 
     def ikComplete(self, ik):
         '''Called when the main solver completes'''
+        main = self.solvers['main'][0]
+        if ik.resolution == main.resolution and not ik.approximate:
+            # Load ghosts held back for the full resolution geometry
+            deferred = self.deferred_ghosts
+            self.deferred_ghosts = {}
+            for solver, args in deferred.items():
+                self.solveGhost(solver, *args)
         self.main_outline.update(ik)
-        self.heatmap.update(ik)
+        if self.view_solver.region is None:
+            self.heatmap.update(ik)
         self.histogram.update(ik)
         self.selected_arm_vis.update()
 
@@ -331,4 +464,3 @@ class RVWindow(QMainWindow):
     def closeEvent(self, event):
         # Smash up our async workers
         self.ik_pool.terminate()
-        self._active = False
@@ -1,12 +1,100 @@
+from collections import OrderedDict
 from multiprocessing.pool import Pool
+from multiprocessing.sharedctypes import RawArray
+import heapq
+import itertools
+import multiprocessing
 import os
+import queue
+
+# Maximum number of distinct refs which can have their jobs cancelled
+max_slots = 1024
+
+# Job priority classes; lower values are run first, and may preempt jobs of
+# a higher class which are already running
+priority_main = 0
+priority_ghost = 1
+priority_perpendicular = 2
+priority_scrub = 3
+
+class RVJobCancelled(Exception):
+    '''Raised inside a worker when its job has been superseded'''
+    pass
+
+# Worker-side state: the shared generation counters, the shared result
+# buffers, and the job being run (and its buffer)
+_generations = None
+_buffers = None
+_current_job = None
+_current_buffer = None
+_buffer_used = False
+
+def _initWorker(generations, buffers=None):
+    global _generations, _buffers
+    _generations = generations
+    _buffers = buffers
+
+def jobCancelled():
+    '''Worker-side check for whether the running job has been superseded
+
+    Long-running job functions should call this periodically (e.g. between
+    chunks of work) and raise RVJobCancelled if it returns True.'''
+    if _current_job is None or _generations is None:
+        return False
+    slot, generation = _current_job
+    return _generations[slot] != generation
+
+def jobBuffer():
+    '''Worker-side access to the shared buffer lent to the running job
+
+    Returns (index, buffer), or None if the job has no buffer. A job which
+    takes its buffer hands it over to the parent along with its result, so
+    the result must say where to find it (the index); see RVWorkerPool.'''
+    global _buffer_used
+    if _current_buffer is None or _buffers is None:
+        return None
+    _buffer_used = True
+    return (_current_buffer, _buffers[_current_buffer])
+
+def _runJob(func, args, slot, generation, buffer=None):
+    '''Runs a job in a worker, returning (cancelled, result, buffer used)'''
+    global _current_job, _current_buffer, _buffer_used
+    _current_buffer = buffer
+    _buffer_used = False
+    if slot is not None:
+        _current_job = (slot, generation)
+    try:
+        # It may have been superseded while waiting in the pool's queue
+        if jobCancelled():
+            return (True, None, False)
+        result = func(*args)
+        return (False, result, _buffer_used)
+    except RVJobCancelled:
+        return (True, None, False)
+    finally:
+        _current_job = None
+        _current_buffer = None
 
 class JobRef(object):
-    def __init__(self, func, args, ref=None, priority=1):
+    def __init__(self, func, args, ref=None, priority=priority_ghost, callback=None):
         self.func = func
         self.args = args
         self.ref = ref
         self.priority= priority
+        self.callback = callback
+        self.slot = None
+        self.generation = 0
+        # Set once the job has been superseded, cancelled or preempted
+        self.dropped = False
+        # The re-queued copy of a preempted job
+        self.requeued = None
+        # Queue position within the priority class
+        self.order = None
+        # Whether the job may be lent a shared buffer, and which it was lent
+        self.shared = False
+        self.buffer = None
+        # Identifies what the job computes, for sharing (see registerJob)
+        self.key = None
         self._res = None
         self._started = False
 
@@ -30,36 +118,375 @@ class JobRef(object):
             return self._res.get()
 
 class RVWorkerPool(object):
-    def __init__(self, processes=None):
-        self.pool = Pool(processes)
+    '''Process pool which delivers job results as they complete
+
+    Completed jobs are queued up from the pool's result thread, and the
+    'completed' subscribers are notified (from that thread) - they should
+    arrange for poll() to be called on the main thread, which then runs the
+    job callbacks and starts any waiting jobs.
+
+    Jobs are coalesced per ref: registering a job supersedes any earlier
+    job from the same ref. Waiting jobs are dropped outright, and running
+    ones are cancelled cooperatively through a shared generation counter
+    per ref (see jobCancelled), so only the newest job keeps a core busy.
+
+    Waiting jobs are held in a heap ordered by priority class (then age). A
+    job which arrives while every core is busy preempts a running job of a
+    lower class, if there is one; that job is cancelled and re-queued.
+
+    Jobs registered as shared are lent one of a fixed set of shared memory
+    buffers (while any are free), which they can fill in place of pickling
+    a large result (see jobBuffer). A job which uses its buffer passes it on
+    to its callback, which must hand it back with releaseBuffer once the
+    result is no longer needed; buffers of cancelled or failed jobs, or of
+    jobs which didn't use them, are reclaimed automatically.
+
+    Jobs registered with a key are shared: every requester of the same key
+    is attached to one job, and each gets its result (and must release its
+    buffer, if it has one). The job is only cancelled once all of its
+    requesters have gone, and runs at the most urgent of their priorities.
+    The last result_cache results are also kept, and handed straight back
+    to any later requester of the same key. Shared results must be treated
+    as read-only.'''
+    def __init__(self, processes=None, shared_buffers=0, shared_buffer_size=0, result_cache=0):
+        self.generations = multiprocessing.Array('q', max_slots, lock=False)
+        # Inherited by the workers, so never pickled
+        self.buffers = [RawArray('b', shared_buffer_size) for i in range(shared_buffers)]
+        self.free_buffers = list(range(shared_buffers))
+        # Holders of shared buffers which have more than one
+        self.buffer_refs = {}
+        self.pool = Pool(processes,
+                         initializer=_initWorker,
+                         initargs=(self.generations, self.buffers))
         self.pipe_target = os.cpu_count()
         self.in_pipe = 0
-        self.jobs = []
+        self.waiting = []
+        self.waiting_by_ref = {}
+        self.running = []
+        self.counter = itertools.count()
+        self.slots = {}
+        self.free_slots = []
+        # In-flight keyed jobs, by key; each runs under a ref of its own,
+        # with the refs of its requesters attached to it
+        self.shared = {}
+        self.attached = {}
+        # Recent results of keyed jobs, as (result, buffer), by key
+        self.results = OrderedDict()
+        self.result_cache = result_cache
+        self.completed = queue.Queue()
+        self.subscribers = {
+            'completed': []
+        }
 
-    def registerJob(self, func, args, ref=None, priority=1):
-        job = JobRef(func, args, ref, priority)
-        # Replace duplicate-source unstarted jobs
+    def registerJob(self, func, args, ref=None, priority=priority_ghost, callback=None,
+                    shared=False, key=None):
+        if key is not None:
+            return self.registerShared(func, args, ref, priority, callback, shared, key)
+        job = JobRef(func, args, ref, priority, callback)
+        job.shared = shared
         if ref is not None:
-            self.jobs = [j for j in self.jobs if j.ref != ref or j.started()]
-        self.jobs.append(job)
-        if self.in_pipe < self.pipe_target:
-            job.jobStarted(self.pool.apply_async(func, args))
-            self.in_pipe += 1
+            self.cancel(ref)
+            job.slot = self.slotFor(ref)
+            if job.slot is not None:
+                job.generation = self.generations[job.slot]
+        self.queueJob(job)
+        self.preempt(priority)
+        self.dispatch()
         return job
 
+    def registerShared(self, func, args, ref, priority, callback, shared, key):
+        '''Registers a keyed job, attaching to an identical one if possible'''
+        entry = self.shared.get(key)
+        if ref is not None and entry is not None and self.attached.get(ref) == key:
+            # Already waiting on the very same job
+            entry['requesters'] = [(r, callback, priority) if r is ref else (r, c, p)
+                                   for r, c, p in entry['requesters']]
+            self.prioritizeShared(entry)
+            return entry['job']
+        if ref is not None:
+            self.cancel(ref)
+        if key in self.results:
+            result, buffer = self.results[key]
+            self.results.move_to_end(key)
+            if callback is not None:
+                self.retainBuffer(buffer)
+                callback(result)
+            return None
+        entry = self.shared.get(key)
+        if entry is None:
+            internal = ('shared', key)
+            job = JobRef(func, args, internal, priority)
+            job.shared = shared
+            job.key = key
+            job.slot = self.slotFor(internal)
+            if job.slot is not None:
+                job.generation = self.generations[job.slot]
+            entry = self.shared[key] = {
+                'ref': internal,
+                'job': job,
+                'priority': priority,
+                'requesters': [],
+            }
+            self.queueJob(job)
+            self.preempt(priority)
+            self.dispatch()
+        entry['requesters'].append((ref, callback, priority))
+        if ref is not None:
+            self.attached[ref] = key
+        self.prioritizeShared(entry)
+        return entry['job']
+
+    def prioritizeShared(self, entry):
+        '''Runs a keyed job at the most urgent of its requesters' priorities'''
+        priority = min(p for r, c, p in entry['requesters'])
+        if priority != entry['priority']:
+            entry['priority'] = priority
+            self.setPriority(entry['ref'], priority)
+
+    def dropShared(self, key):
+        '''Detaches a keyed job's requesters, returning its entry (or None)'''
+        entry = self.shared.pop(key, None)
+        if entry is not None:
+            for ref, callback, priority in entry['requesters']:
+                if ref is not None:
+                    del self.attached[ref]
+            # Its generation only ever goes up, so the slot is safe to reuse
+            slot = self.slots.pop(entry['ref'], None)
+            if slot is not None:
+                self.free_slots.append(slot)
+        return entry
+
+    def queueJob(self, job):
+        if job.order is None:
+            job.order = next(self.counter)
+        heapq.heappush(self.waiting, (job.priority, job.order, job))
+        if job.ref is not None:
+            self.waiting_by_ref[job.ref] = job
+
+    def slotFor(self, ref):
+        '''The generation counter slot for ref (None once they run out)'''
+        if ref not in self.slots:
+            if len(self.free_slots) > 0:
+                self.slots[ref] = self.free_slots.pop()
+            elif len(self.slots) >= max_slots:
+                return None
+            else:
+                self.slots[ref] = len(self.slots)
+        return self.slots[ref]
+
+    def cancel(self, ref):
+        '''Cancels all outstanding jobs from ref
+
+        A keyed job is only cancelled once none of its requesters want it.'''
+        key = self.attached.get(ref)
+        if key is not None:
+            entry = self.shared[key]
+            requesters = [(r, c, p) for r, c, p in entry['requesters'] if r is not ref]
+            if len(requesters) > 0:
+                entry['requesters'] = requesters
+                del self.attached[ref]
+                self.prioritizeShared(entry)
+            else:
+                self.cancel(entry['ref'])
+                self.dropShared(key)
+        waiting = self.waiting_by_ref.pop(ref, None)
+        if waiting is not None:
+            waiting.dropped = True
+        # Bumping the generation cancels any running jobs for this ref
+        slot = self.slots.get(ref)
+        if slot is not None:
+            self.generations[slot] += 1
+            for job in self.running:
+                if job.ref == ref:
+                    job.dropped = True
+
+    def setPriority(self, ref, priority):
+        '''Changes the priority of ref's job
+
+        A waiting job moves in the queue, and a running one is only
+        preempted by jobs more urgent than its new priority. A requester of
+        a keyed job just changes its own priority; the job runs at the most
+        urgent of its requesters'.'''
+        key = self.attached.get(ref)
+        if key is not None:
+            entry = self.shared[key]
+            entry['requesters'] = [(r, c, priority) if r is ref else (r, c, p)
+                                   for r, c, p in entry['requesters']]
+            self.prioritizeShared(entry)
+            return
+        for job in self.running:
+            if job.ref == ref and not job.dropped:
+                job.priority = priority
+        job = self.waiting_by_ref.get(ref)
+        if job is not None and job.priority != priority:
+            job.priority = priority
+            self.waiting = [(j.priority, j.order, j) for p, order, j in self.waiting
+                            if not j.dropped]
+            heapq.heapify(self.waiting)
+            self.preempt(priority)
+            self.dispatch()
+
+    def preempt(self, priority):
+        '''Makes room for the waiting jobs of the given priority class and above
+
+        Free cores, and cores still winding down a cancelled job, are counted
+        first. For each of those jobs left without one, a running job of the
+        lowest class below the given one is cancelled and re-queued, to be
+        restarted once it reaches the front.'''
+        urgent = sum(1 for p, order, job in self.waiting
+                     if p <= priority and not job.dropped)
+        yielding = sum(1 for job in self.running if job.dropped)
+        room = self.pipe_target - self.in_pipe + yielding
+        if urgent <= room:
+            return
+        candidates = [job for job in self.running
+                      if not job.dropped and job.priority > priority and job.slot is not None]
+        candidates.sort(key=lambda job: job.priority, reverse=True)
+        for victim in candidates[:urgent - room]:
+            victim.dropped = True
+            self.generations[victim.slot] += 1
+            job = JobRef(victim.func, victim.args, victim.ref,
+                         victim.priority, victim.callback)
+            job.shared = victim.shared
+            job.key = victim.key
+            if job.key is not None and job.key in self.shared:
+                self.shared[job.key]['job'] = job
+            job.slot = victim.slot
+            job.generation = self.generations[victim.slot]
+            victim.requeued = job
+            # Keeps its place in the queue, ahead of later jobs of its class
+            job.order = victim.order
+            self.queueJob(job)
+
+    def dispatch(self):
+        '''Starts the highest priority waiting jobs, while there are cores free'''
+        while self.in_pipe < self.pipe_target and len(self.waiting) > 0:
+            priority, order, job = heapq.heappop(self.waiting)
+            if job.dropped:
+                continue
+            if job.ref is not None and self.waiting_by_ref.get(job.ref) is job:
+                del self.waiting_by_ref[job.ref]
+            self.startJob(job)
+
+    def startJob(self, job):
+        def done(result):
+            # Called on the pool's result thread
+            self.completed.put(job)
+            for func in self.subscribers['completed']:
+                func()
+        if job.shared and len(self.free_buffers) > 0:
+            job.buffer = self.free_buffers.pop()
+        job.jobStarted(self.pool.apply_async(_runJob,
+                                             (job.func, job.args, job.slot,
+                                              job.generation, job.buffer),
+                                             callback=done,
+                                             error_callback=done))
+        self.running.append(job)
+        self.in_pipe += 1
+
+    def subscribe(self, event, func):
+        self.subscribers[event].append(func)
+
+    def pending(self):
+        '''Whether any jobs are waiting or running'''
+        return self.in_pipe > 0 or \
+            any(not job.dropped for p, order, job in self.waiting)
+
     def poll(self):
-        done = []
-        sorted_jobs = sorted(self.jobs, key=lambda j: j.priority)
-        for job in sorted_jobs:
-            if job.started():
-                # Check if it's finished
-                if job.ready():
-                    self.jobs.remove(job)
-                    self.in_pipe -= 1
+        '''Delivers completed results and starts waiting jobs (main thread)'''
+        while True:
+            try:
+                job = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            self.finishJob(job)
+        self.dispatch()
+
+    def wait(self, done=None):
+        '''Blocks, delivering results as they complete, until done() is True
+
+        Without done, waits for every job to finish. Also returns if there is
+        nothing left to wait for.'''
+        while not (done() if done is not None else not self.pending()):
+            if not self.pending():
+                break
+            self.finishJob(self.completed.get())
+            self.poll()
+
+    def finishJob(self, job):
+        '''Runs the callback of a completed job, if it still wants its result'''
+        self.running.remove(job)
+        self.in_pipe -= 1
+        try:
+            cancelled, result, buffer_used = job.get()
+        except Exception as e:
+            print('Warning: job failed: ', e)
+            self.releaseBuffer(job.buffer)
+            if job.key is not None and self.sharedEntry(job) is not None:
+                self.dropShared(job.key)
+            return
+        if not buffer_used or cancelled or (job.callback is None and job.key is None):
+            self.releaseBuffer(job.buffer)
+        if cancelled:
+            return
+        if job.requeued is not None:
+            # Preempted too late to stop it; the re-run isn't needed
+            job.requeued.dropped = True
+            if self.waiting_by_ref.get(job.ref) is job.requeued:
+                del self.waiting_by_ref[job.ref]
+        if job.key is not None:
+            self.finishShared(job, result, job.buffer if buffer_used else None)
+        elif job.callback is not None:
+            job.callback(result)
+
+    def sharedEntry(self, job):
+        '''The entry of a keyed job, unless it has since been replaced'''
+        entry = self.shared.get(job.key)
+        if entry is not None and entry['job'] in (job, job.requeued):
+            return entry
+        return None
+
+    def finishShared(self, job, result, buffer):
+        '''Hands a keyed job's result to each of its requesters, and caches it'''
+        requesters = []
+        if self.sharedEntry(job) is not None:
+            requesters = self.dropShared(job.key)['requesters']
+        callbacks = [callback for ref, callback, priority in requesters if callback is not None]
+        holders = len(callbacks) + (1 if self.result_cache > 0 else 0)
+        if buffer is not None:
+            if holders > 0:
+                self.buffer_refs[buffer] = holders
             else:
-                if self.in_pipe < self.pipe_target:
-                    job.jobStarted(self.pool.apply_async(job.func, job.args))
-                    self.in_pipe += 1
+                self.releaseBuffer(buffer)
+        if self.result_cache > 0:
+            old = self.results.pop(job.key, None)
+            if old is not None:
+                self.releaseBuffer(old[1])
+            self.results[job.key] = (result, buffer)
+            while len(self.results) > self.result_cache:
+                self.releaseBuffer(self.results.popitem(last=False)[1][1])
+        for callback in callbacks:
+            callback(result)
+
+    def bufferArray(self, index):
+        '''The shared buffer of the given index (see jobBuffer)'''
+        return self.buffers[index]
+
+    def retainBuffer(self, index):
+        '''Adds a holder to a shared buffer, which must release it in turn'''
+        if index is not None:
+            self.buffer_refs[index] = self.buffer_refs.get(index, 1) + 1
+
+    def releaseBuffer(self, index):
+        '''Hands a shared buffer back, to be lent to later jobs once its
+        last holder has released it'''
+        if index is None:
+            return
+        holders = self.buffer_refs.pop(index, 1) - 1
+        if holders > 0:
+            self.buffer_refs[index] = holders
+        elif index not in self.free_buffers:
+            self.free_buffers.append(index)
 
     def terminate(self):
         self.pool.terminate()
@@ -0,0 +1,52 @@
+import time
+import unittest
+
+from robovis import RVConfig
+from robovis.ik import RVSolver
+from robovis.workerpool import RVWorkerPool, priority_ghost, priority_perpendicular
+
+class TestSharedPriority(unittest.TestCase):
+    '''Re-prioritizing a solver whose solve is a keyed (shared) job'''
+    def setUp(self):
+        self.pool = RVWorkerPool(1)
+        self.pool.pipe_target = 1
+        # Keeps the only core busy, so the solves below stay waiting
+        self.pool.registerJob(time.sleep, [0.5])
+
+    def tearDown(self):
+        self.pool.terminate()
+
+    def waitingJob(self, solver):
+        entry = self.pool.shared[self.pool.attached[solver]]
+        return self.pool.waiting_by_ref[entry['ref']]
+
+    def config(self, elevator_length):
+        config = RVConfig()
+        config['elevator_length'].value = elevator_length
+        return config
+
+    def test_raise_waiting(self):
+        a = RVSolver(self.pool, resolution=20)
+        b = RVSolver(self.pool, resolution=20)
+        a.solveAsync(self.config(150), priority_perpendicular)
+        b.solveAsync(self.config(160), priority_perpendicular)
+        b.setPriority(priority_ghost)
+        self.assertEqual(self.waitingJob(b).priority, priority_ghost)
+        self.assertEqual(self.waitingJob(a).priority, priority_perpendicular)
+        # b's job is now at the front of the queue
+        self.assertIs(self.pool.waiting[0][2], self.waitingJob(b))
+
+    def test_most_urgent_requester(self):
+        a = RVSolver(self.pool, resolution=20)
+        b = RVSolver(self.pool, resolution=20)
+        a.solveAsync(self.config(150), priority_perpendicular)
+        b.solveAsync(self.config(150), priority_perpendicular)
+        self.assertIs(self.waitingJob(a), self.waitingJob(b))
+        b.setPriority(priority_ghost)
+        self.assertEqual(self.waitingJob(a).priority, priority_ghost)
+        # Back to the remaining requester's priority once b goes
+        self.pool.cancel(b)
+        self.assertEqual(self.waitingJob(a).priority, priority_perpendicular)
+
+if __name__ == '__main__':
+    unittest.main()